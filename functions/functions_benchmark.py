@@ -0,0 +1,775 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the projections and of the data / training pipeline.
+
+Each bench_* function prints a small table and returns it as a DataFrame.
+The reference (previous) implementations kept here are only used to check
+that the optimized versions give the same results.
+"""
+
+import gc
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import torch
+
+import functions.functions_torch_regression_V4 as ft
+
+
+def timeit(fn, *args, repeat=3, device="cpu", **kwargs):
+    """Best wall time (s) of fn(*args, **kwargs) over repeat runs"""
+    best = np.inf
+    for _ in range(repeat):
+        if "cuda" in str(device):
+            torch.cuda.synchronize()
+        t1 = time.perf_counter()
+        fn(*args, **kwargs)
+        if "cuda" in str(device):
+            torch.cuda.synchronize()
+        t2 = time.perf_counter()
+        best = min(best, t2 - t1)
+    return best
+
+
+def residentMemory():
+    """Resident memory of the process (MB), nan where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return np.nan
+
+
+def peakResident(fn, *args, interval=0.005, **kwargs):
+    """(wall time, increase of the resident memory in MB) of fn(*args, **kwargs),
+    the memory being sampled every interval seconds by a thread"""
+    gc.collect()
+    start = residentMemory()
+    peak = [start]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], residentMemory())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    t1 = time.perf_counter()
+    fn(*args, **kwargs)
+    t2 = time.perf_counter()
+    done.set()
+    sampler.join()
+    peak[0] = max(peak[0], residentMemory())
+    return t2 - t1, peak[0] - start
+
+
+# ===========================================================================
+# Reference implementations
+# ===========================================================================
+
+
+def proj_l1ball_sort(w0, eta, device="cpu"):
+    """Previous (sort) version of ft.proj_l1ball, frozen here so that the
+    references below do not share the code of the optimized projections"""
+    w = torch.as_tensor(w0, dtype=torch.get_default_dtype(), device=device)
+
+    init_shape = w.size()
+
+    if w.dim() > 1:
+        init_shape = w.size()
+        w = w.reshape(-1)
+
+    Res = torch.sign(w) * torch.max(
+        torch.abs(w)
+        - torch.max(
+            torch.cat(
+                (
+                    (
+                        torch.cumsum(
+                            torch.sort(torch.abs(w), dim=0, descending=True)[0],
+                            dim=0,
+                            dtype=torch.get_default_dtype(),
+                        )
+                        - eta
+                    )
+                    / torch.arange(
+                        start=1,
+                        end=w.numel() + 1,
+                        device=device,
+                        dtype=torch.get_default_dtype(),
+                    ),
+                    torch.tensor([0.0], dtype=torch.get_default_dtype(), device=device),
+                )
+            )
+        ),
+        torch.zeros_like(w),
+    )
+
+    Q = Res.reshape(init_shape).clone().detach()
+
+    if not torch.is_tensor(w0):
+        Q = Q.data.numpy()
+    return Q
+
+
+def bilevel_proj_l1Inftyball_loop(w2, eta, device="cpu"):
+    """Previous column loop version of ft.bilevel_proj_l1Inftyball (AXIS=1)"""
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+
+    init_shape = w.shape
+    Res = torch.empty(init_shape)
+    nrow, ncol = init_shape[0:2]
+
+    W = torch.tensor(
+        [torch.max(torch.abs(w[:, i])).data.item() for i in range(ncol)]
+    )
+
+    PW = proj_l1ball_sort(W, eta, device=device)
+
+    for i in range(ncol):
+        Res[:, i] = torch.clamp(torch.abs(w[:, i]), max=PW[i].data.item())
+        Res[:, i] = Res[:, i].to(device) * torch.sign(w[:, i]).to(device)
+
+    return Res
+
+
+def proj_l11ball_loop(w2, eta, device="cpu", line=False):
+    """Previous loop version of ft.proj_l11ball (ft.proj_l11ball_line if line)"""
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+    if line:
+        w = w.T
+
+    init_shape = w.shape
+    Res = torch.empty(init_shape)
+    nrow, ncol = init_shape[0:2]
+
+    W = torch.tensor(
+        [torch.sum(torch.abs(w[:, i])).data.item() for i in range(ncol)]
+    )
+
+    PW = ft.proj_l1ball(W, eta, device=device)
+
+    for i in range(ncol):
+        Res[:, i] = ft.proj_l1ball(w[:, i], PW[i].data.item(), device=device, method="sort")
+
+    return Res.T if line else Res
+
+
+def proj_l21ball_loop(w2, eta, device="cpu"):
+    """Previous loop version of ft.proj_l21ball"""
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+
+    init_shape = w.shape
+    Res = torch.empty(init_shape)
+    nrow, ncol = init_shape[0:2]
+
+    W = torch.tensor(
+        [torch.sum(torch.abs(w[:, i])).data.item() for i in range(ncol)]
+    )
+
+    PW = ft.proj_l1ball(W, eta, device=device)
+
+    for i in range(ncol):
+        Res[:, i] = ft.proj_l2ball(w[:, i], PW[i].data.item(), device=device)
+
+    return Res
+
+
+def proj_l1inf_numpy_loop(Y, c, tol=1e-5, direction="row"):
+    """Previous row loop version of ft.proj_l1inf_numpy"""
+    if direction == "col":
+        Y = np.transpose(Y)
+
+    X = np.flip(np.sort(np.abs(Y), axis=1), axis=1)
+    v = np.sum(X[:, 0])
+    if v <= c:
+        X = Y
+    else:
+        N, M = Y.shape
+        S = np.cumsum(X, axis=1)
+        idx = np.ones((N, 1), dtype=int)
+        theta = (v - c) / N
+        mu = np.zeros((N, 1))
+        active = np.ones((N, 1))
+        theta_old = 0
+        while np.abs(theta_old - theta) > tol:
+            for n in range(N):
+                if active[n]:
+                    j = idx[n]
+                    while (j < M) and ((S[n, j - 1] - theta) / j) < X[n, j]:
+                        j += 1
+                    idx[n] = j
+                    mu[n] = S[n, j - 1] / j
+                    if j == M and (mu[n] - (theta / j)) <= 0:
+                        active[n] = 0
+                        mu[n] = 0
+            theta_old = theta
+            theta = (np.sum(mu) - c) / (np.sum(active / idx))
+        X = np.minimum(np.abs(Y), (mu - theta / idx) * active)
+        X = X * np.sign(Y)
+
+    if direction == "col":
+        X = np.transpose(X)
+    return X
+
+
+def proj_l1Inftyball_line_loop(w2, C, device="cpu"):
+    """Previous element-wise version of ft.proj_l1Inftyball_line, with the
+    active column list copied before iterating over it
+    """
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+
+    nrow, ncol = w.shape[0:2]
+
+    X = torch.abs(w)
+    X = torch.sort(X, 0, True).values
+    S = torch.cumsum(X, 0)
+
+    k = [0 for _ in range(ncol)]
+    a = [j for j in range(ncol)]
+    theta_num = sum([X[0, i] for i in range(ncol)])
+    theta_den = ncol
+    theta = (theta_num - C) / theta_den
+    changed = True
+    while changed:
+        for j in list(a):
+            i = k[j]
+            while i < nrow - 1 and (S[i, j] - theta) / (i + 1) < X[i + 1, j]:
+                i += 1
+            theta_num -= S[k[j], j] / (k[j] + 1)
+            theta_den -= 1.0 / (k[j] + 1)
+            k[j] = i
+            if i == nrow - 1 and S[i, j] < theta:
+                a.remove(j)
+                continue
+            theta_num += S[k[j], j] / (k[j] + 1)
+            theta_den += 1.0 / (k[j] + 1)
+        theta_prime = (theta_num - C) / theta_den
+        changed = theta_prime != theta
+        theta = theta_prime
+
+    Q = w.clone()
+    for j in range(ncol):
+        if S[-1, j] < theta:
+            Q[:, j] = 0
+        else:
+            mu = (S[k[j], j] - theta) / (k[j] + 1)
+            Q[:, j] = torch.min(mu, abs(Q[:, j]))
+    return Q * torch.sign(w)
+
+
+# ===========================================================================
+# Benchmarks
+# ===========================================================================
+
+
+def bench_bilevel_l1inf(
+    ncols=(500, 2000, 10000, 50000, 200000), nrow=300, eta=1.0, repeat=3,
+    device="cpu", seed=0, loop_max_cols=50000
+):
+    """Scaling of bilevel_proj_l1Inftyball with the number of columns,
+    checked against the previous column loop with the previous sort
+    projection (max deviation, and whether both are identical).
+    The loop version is only timed up to loop_max_cols columns.
+    """
+    torch.manual_seed(seed)
+    rows = []
+    for ncol in ncols:
+        w = torch.randn(nrow, ncol, device=device)
+        t_vec = timeit(ft.bilevel_proj_l1Inftyball, w, eta, device, repeat=repeat,
+                       device=device)
+        t_vec_row = timeit(ft.bilevel_proj_l1Inftyball, w.T, eta, device, AXIS=0,
+                           repeat=repeat, device=device)
+        if ncol <= loop_max_cols:
+            t_loop = timeit(bilevel_proj_l1Inftyball_loop, w, eta, device,
+                            repeat=1, device=device)
+            Q_loop = bilevel_proj_l1Inftyball_loop(w, eta, device).to(device)
+            Q_vec = ft.bilevel_proj_l1Inftyball(w, eta, device).detach()
+            err = torch.max(torch.abs(Q_loop - Q_vec)).item()
+            same = torch.equal(Q_loop, Q_vec)
+        else:
+            t_loop, err, same = np.nan, np.nan, None
+        rows.append([ncol, t_loop, t_vec, t_vec_row, t_loop / t_vec, err, same])
+    df = pd.DataFrame(
+        rows,
+        columns=["Columns", "Loop (s)", "Vectorized (s)", "Vectorized AXIS=0 (s)",
+                 "Speedup", "Max error", "Identical"],
+    )
+    print("\nbilevel_proj_l1Inftyball, {} rows".format(nrow))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_l1ball(
+    sizes=(100, 1000, 4096, 10000, 100000, 1000000), radius=(1.0, 0.1), repeat=3,
+    device="cpu", seed=0
+):
+    """Crossover of the sort, pivot and topk algorithms of proj_l1ball, and
+    max deviation of each from the previous sort projection (proj_l1ball_sort).
+    radius: eta as a fraction of the l1 norm of the input (small: few survivors)
+    """
+    torch.manual_seed(seed)
+    rows = []
+    for n in sizes:
+        w = torch.randn(n, device=device)
+        for r in radius:
+            eta = r if r >= 1 else r * torch.sum(torch.abs(w)).item()
+            times = [
+                timeit(ft.proj_l1ball, w, eta, device, method=m, repeat=repeat,
+                       device=device)
+                for m in ["sort", "pivot", "topk"]
+            ]
+            Q_ref = proj_l1ball_sort(w, eta, device)
+            errs = [
+                torch.max(torch.abs(ft.proj_l1ball(w, eta, device, method=m) - Q_ref)).item()
+                for m in ["sort", "pivot", "topk"]
+            ]
+            auto = "sort" if n <= ft.L1BALL_SORT_MAX else "pivot"
+            rows.append([n, eta, *times, auto, *errs])
+    df = pd.DataFrame(
+        rows,
+        columns=["Size", "Eta", "Sort (s)", "Pivot (s)", "Topk (s)", "Auto",
+                 "Sort error", "Pivot error", "Topk error"],
+    )
+    print("\nproj_l1ball")
+    print(df.to_string(index=False))
+
+    # edge cases: eta 0, eta below the resolution of max|w|, tied entries
+    cases = [
+        ("eta 0", torch.randn(5000, device=device), 0.0),
+        ("eta 1e-9", torch.randn(5000, device=device) + 1e3, 1e-9),
+        ("ties", torch.ones(10000, device=device), 1.0),
+    ]
+    rows = []
+    for name, w, eta in cases:
+        Q_sort = proj_l1ball_sort(w, eta, device)
+        results = [ft.proj_l1ball(w, eta, device, method=m) for m in ["pivot", "topk"]]
+        rows.append([
+            name, torch.sum(torch.abs(Q_sort)).item(),
+            *[torch.sum(torch.abs(Q)).item() for Q in results],
+            max(torch.max(torch.abs(Q - Q_sort)).item() for Q in results),
+        ])
+    df_cases = pd.DataFrame(
+        rows, columns=["Case", "Sort l1", "Pivot l1", "Topk l1", "Max error"]
+    )
+    print(df_cases.to_string(index=False))
+    return df
+
+
+def bench_columnwise(
+    ncols=(500, 5000, 50000), nrow=300, eta=10.0, repeat=3, device="cpu", seed=0,
+    loop_max_cols=50000
+):
+    """Loop vs batched engine for proj_l11ball, proj_l11ball_line and proj_l21ball"""
+    torch.manual_seed(seed)
+    cases = [
+        ("proj_l11ball", ft.proj_l11ball, proj_l11ball_loop, {}),
+        ("proj_l11ball_line", ft.proj_l11ball_line, proj_l11ball_loop, {"line": True}),
+        ("proj_l21ball", ft.proj_l21ball, proj_l21ball_loop, {}),
+    ]
+    rows = []
+    for ncol in ncols:
+        w = torch.randn(nrow, ncol, device=device)
+        for name, fn, fn_loop, kw in cases:
+            t_batch = timeit(fn, w, eta, device, repeat=repeat, device=device)
+            if ncol <= loop_max_cols:
+                t_loop = timeit(fn_loop, w, eta, device, repeat=1, device=device, **kw)
+                err = torch.max(torch.abs(
+                    fn_loop(w, eta, device, **kw).to(device) - fn(w, eta, device).detach()
+                )).item()
+            else:
+                t_loop, err = np.nan, np.nan
+            rows.append([name, ncol, t_loop, t_batch, t_loop / t_batch, err])
+    df = pd.DataFrame(
+        rows,
+        columns=["Projection", "Columns", "Loop (s)", "Batched (s)", "Speedup", "Max error"],
+    )
+    print("\nColumn-wise projections, {} rows".format(nrow))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_l1inf(
+    shapes=((300, 500), (300, 5000), (300, 50000), (1000, 20000)), eta=1.0,
+    repeat=3, seed=0, tol=1e-5, loop_max_cols=5000
+):
+    """Exact l1,inf projection (row loop vs vectorized proj_l1inf_numpy)
+    and the bilevel l1,inf projection, column direction (AXIS=1)
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for shape in shapes:
+        Y = rng.standard_normal(shape).astype(np.float32)
+        w = torch.as_tensor(Y)
+        t_vec = timeit(ft.proj_l1inf_numpy, Y, eta, tol=tol, direction="col",
+                       repeat=repeat)
+        t_bilevel = timeit(ft.bilevel_proj_l1Inftyball, w, eta, repeat=repeat)
+        if shape[1] <= loop_max_cols:
+            t_loop = timeit(proj_l1inf_numpy_loop, Y, eta, tol=tol, direction="col",
+                            repeat=1)
+            err = np.max(np.abs(
+                proj_l1inf_numpy_loop(Y, eta, tol=tol, direction="col")
+                - ft.proj_l1inf_numpy(Y, eta, tol=tol, direction="col")
+            ))
+        else:
+            t_loop, err = np.nan, np.nan
+        rows.append([str(shape), t_loop, t_vec, t_bilevel, t_loop / t_vec, err])
+    df = pd.DataFrame(
+        rows,
+        columns=["Shape", "l1inf loop (s)", "l1inf vectorized (s)", "Bilevel l1inf (s)",
+                 "Speedup", "Max error"],
+    )
+    print("\nl1,inf projections, eta = {}".format(eta))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_l1inf_line(
+    shapes=((50, 100), (300, 500), (300, 5000)), eta=1.0, repeat=3, device="cpu",
+    seed=0, loop_max_cols=500
+):
+    """Element-wise loop vs tensorized proj_l1Inftyball_line"""
+    torch.manual_seed(seed)
+    rows = []
+    for shape in shapes:
+        w = torch.randn(shape, device=device)
+        t_vec = timeit(ft.proj_l1Inftyball_line, w, eta, device, repeat=repeat,
+                       device=device)
+        if shape[1] <= loop_max_cols:
+            t_loop = timeit(proj_l1Inftyball_line_loop, w, eta, device, repeat=1,
+                            device=device)
+            err = torch.max(torch.abs(
+                proj_l1Inftyball_line_loop(w, eta, device)
+                - ft.proj_l1Inftyball_line(w, eta, device).detach()
+            )).item()
+        else:
+            t_loop, err = np.nan, np.nan
+        rows.append([str(shape), t_loop, t_vec, t_loop / t_vec, err])
+    df = pd.DataFrame(
+        rows, columns=["Shape", "Loop (s)", "Tensorized (s)", "Speedup", "Max error"]
+    )
+    print("\nproj_l1Inftyball_line, eta = {}".format(eta))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_eta_path(
+    shape=(300, 50000), n_etas=(10, 100, 500), eta_max=50.0, repeat=3, device="cpu",
+    seed=0, tol=1.0e-3
+):
+    """ETA scan: repeated bilevel_proj_l1Inftyball + sparsity_col calls vs
+    one bilevel_proj_l1Inftyball_path call
+    """
+    torch.manual_seed(seed)
+    w = torch.randn(shape, device=device)
+
+    def scan(etas):
+        return [
+            ft.sparsity_col(ft.bilevel_proj_l1Inftyball(w, eta, device).detach(), tol=tol)
+            for eta in etas
+        ]
+
+    rows = []
+    for n in n_etas:
+        etas = np.linspace(eta_max / n, eta_max, n)
+        t_path = timeit(ft.bilevel_proj_l1Inftyball_path, w, etas, device, tol=tol,
+                        repeat=repeat, device=device)
+        # the repeated calls are timed on the first 10 radii and extrapolated
+        t_calls = timeit(scan, etas[:10], repeat=1, device=device) * n / min(n, 10)
+        rows.append([n, t_calls, t_path, t_calls / t_path])
+    df = pd.DataFrame(rows, columns=["Radii", "Repeated calls (s)", "Path (s)", "Speedup"])
+    print("\nETA path, bilevel l1,inf, shape {}".format(shape))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_loader(
+    n_samples=(150, 500, 5000), n_features=500, batch_size=50, epochs=10, repeat=3,
+    device="cpu", seed=0
+):
+    """Training pass throughput: LoadDataset + DataLoader vs TensorLoader,
+    both shuffled, with the batches moved to device
+    """
+    rng = np.random.default_rng(seed)
+
+    def run(loader):
+        for _ in range(epochs):
+            for batch in loader:
+                x = batch[0].to(device)
+                labels = batch[1].to(device)
+
+    rows = []
+    for n in n_samples:
+        dataset = ft.LoadDataset(
+            rng.standard_normal((n, n_features)),
+            rng.random(n),
+            np.array(["P{}".format(i) for i in range(n)]),
+        )
+        data_dl = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+        tensor_dl = ft.TensorLoader(dataset, batch_size=batch_size, shuffle=True,
+                                    device=device)
+        t_data = timeit(run, data_dl, repeat=repeat, device=device)
+        t_tensor = timeit(run, tensor_dl, repeat=repeat, device=device)
+        rows.append([n, n * epochs / t_data, n * epochs / t_tensor, t_data / t_tensor])
+    df = pd.DataFrame(
+        rows, columns=["Samples", "DataLoader (samples/s)", "TensorLoader (samples/s)", "Speedup"]
+    )
+    print("\nMinibatch loader, {} features, batch size {}".format(n_features, batch_size))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_reader(
+    n_samples=(500, 5000), n_features=500, decimal=",", repeat=3, seed=0
+):
+    """Feature-major csv parsing: ft.readDataFile (pandas object frame) vs
+    ft.readDataFast (threaded chunks into a float32 X), on synthetic files
+    """
+    rng = np.random.default_rng(seed)
+
+    def peak(fn, *args, **kwargs):
+        tracemalloc.start()
+        fn(*args, **kwargs)
+        _, traced = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return traced / 2**20
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in n_samples:
+            path = os.path.join(tmp, "Synth_{}s.csv".format(n))
+            df = pd.DataFrame(
+                np.vstack((rng.integers(20, 90, n), rng.standard_normal((n_features, n)))),
+                index=["Label"] + ["Feature_{}".format(i) for i in range(n_features)],
+                columns=["Sample_{}".format(i) for i in range(n)],
+            )
+            df.index.name = "Name"
+            df.to_csv(path, sep=";", decimal=decimal)
+            size = os.path.getsize(path) / 2**20
+            t_pandas = timeit(ft.readDataFile, path, repeat=repeat)
+            t_fast = timeit(ft.readDataFast, path, verbose=False, repeat=repeat)
+            rows.append([
+                n, size, size / t_pandas, size / t_fast, t_pandas / t_fast,
+                peak(ft.readDataFile, path), peak(ft.readDataFast, path, verbose=False),
+            ])
+    df = pd.DataFrame(rows, columns=[
+        "Samples", "File (MB)", "pandas (MB/s)", "Fast (MB/s)", "Speedup",
+        "pandas peak (MB)", "Fast peak (MB)",
+    ])
+    print("\ncsv reader, {} features, traced peak memory".format(n_features))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_memmap(
+    n_samples=(20000, 200000), n_features=200, batch_size=50, block_size=8192,
+    device="cpu", seed=0
+):
+    """One shuffled training pass over a float32 .npy file: loaded in memory
+    (np.load + LoadDataset + TensorLoader, as the CV) vs read block-wise by
+    MemmapLoader. Reports the increase of the resident memory during the pass
+    """
+    rng = np.random.default_rng(seed)
+
+    def run(loader):
+        for batch in loader:
+            x = batch[0].to(device)
+            labels = batch[1].to(device)
+
+    def inMemory(path, Y, names):
+        dataset = ft.LoadDataset(np.load(path), Y, names)
+        run(ft.TensorLoader(dataset, batch_size=batch_size, shuffle=True, device=device))
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in n_samples:
+            path = os.path.join(tmp, "X_{}.npy".format(n))
+            X = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                          shape=(n, n_features))
+            for start in range(0, n, block_size):  # written by blocks
+                X[start : start + block_size] = rng.standard_normal(
+                    (len(X[start : start + block_size]), n_features), dtype=np.float32
+                )
+            X.flush()
+            del X
+            Y = rng.random(n)
+            names = np.array(["P{}".format(i) for i in range(n)])
+            dataset = ft.MemmapDataset(path, Y, names)
+            t_memmap, mem_memmap = peakResident(
+                run, ft.MemmapLoader(dataset, batch_size=batch_size, shuffle=True,
+                                     device=device, block_size=block_size)
+            )
+            t_memory, mem_memory = peakResident(inMemory, path, Y, names)
+            rows.append([
+                n, os.path.getsize(path) / 2**20, mem_memory, mem_memmap,
+                n / t_memory, n / t_memmap,
+            ])
+    df = pd.DataFrame(rows, columns=[
+        "Samples", "File (MB)", "In memory (MB)", "MemmapLoader (MB)",
+        "In memory (samples/s)", "MemmapLoader (samples/s)",
+    ])
+    print("\nOut-of-core training pass, {} features, blocks of {} samples, "
+          "resident memory increase".format(n_features, block_size))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_prune(
+    sparsities=(0.5, 0.8, 0.95), n_features=500, n_hidden=300, batch_size=50,
+    steps=50, repeat=3, device="cpu", seed=0
+):
+    """FairAutoEncoder with dead hidden neurons (a fraction sparsities of the
+    rows of its projected layers set to zero, as AXIS=0) vs the net pruned
+    by ft.pruneNeurons: forward and forward + backward time of steps
+    minibatches, and the largest difference of the outputs
+    """
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, n_features, device=device)
+
+    def forward(net):
+        with torch.no_grad():
+            for _ in range(steps):
+                net(x)
+
+    def backward(net):
+        for _ in range(steps):
+            net.zero_grad()
+            net(x).sum().backward()
+
+    rows = []
+    for norm in (False, True):
+        for sparsity in sparsities:
+            net = ft.FairAutoEncoder(n_features, 1, n_hidden, activation="silu",
+                                     norm=norm).to(device)
+            linears = [m for m in net.encoder if isinstance(m, torch.nn.Linear)]
+            with torch.no_grad():
+                for index, layer in enumerate(linears[:-1]):
+                    if index != len(linears) // 2 - 1:  # not the middle layer
+                        dead = torch.rand(layer.out_features, device=device) < sparsity
+                        layer.weight[dead] = 0
+            net.eval()
+            pruned = ft.pruneNeurons(net)
+            with torch.no_grad():
+                error = (net(x) - pruned(x)).abs().max().item()
+            t_fwd = timeit(forward, net, repeat=repeat, device=device)
+            t_fwd_pruned = timeit(forward, pruned, repeat=repeat, device=device)
+            t_bwd = timeit(backward, net, repeat=repeat, device=device)
+            t_bwd_pruned = timeit(backward, pruned, repeat=repeat, device=device)
+            rows.append([
+                norm, sparsity,
+                sum(p.numel() for p in net.parameters()),
+                sum(p.numel() for p in pruned.parameters()),
+                t_fwd / t_fwd_pruned, t_bwd / t_bwd_pruned, error,
+            ])
+    df = pd.DataFrame(rows, columns=[
+        "norm", "Dead rows", "Parameters", "Pruned parameters",
+        "Forward speedup", "Fwd+bwd speedup", "Max error",
+    ])
+    print("\nNeuron pruning, FairAutoEncoder {} features, n_hidden {}, batch size {}".format(
+        n_features, n_hidden, batch_size))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_sparse(
+    sparsities=(0.5, 0.9, 0.95, 0.99), n_features=500, n_hidden=300, batch_size=1000,
+    repeat=3, device="cpu", seed=0, verbose=False
+):
+    """Inference of a FairAutoEncoder with an unstructured sparsity (a share
+    sparsities of the weights of every layer set to zero) vs the net of
+    ft.sparseNet (threshold 0.9), which keeps a layer dense when its CSR
+    product is slower on this machine. verbose prints the timings of the
+    layers by sparseNet.
+    """
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, n_features, device=device)
+
+    def forward(net):
+        with torch.no_grad():
+            net(x)
+
+    rows = []
+    for sparsity in sparsities:
+        net = ft.FairAutoEncoder(n_features, 1, n_hidden, activation="silu").to(device)
+        with torch.no_grad():
+            for layer in net.encoder:
+                if isinstance(layer, torch.nn.Linear):
+                    layer.weight[torch.rand_like(layer.weight) < sparsity] = 0
+        net.eval()
+        sparse = ft.sparseNet(net, threshold=0.9, batch_size=batch_size, verbose=verbose)
+        with torch.no_grad():  # also warms up both nets
+            error = (net(x) - sparse(x)).abs().max().item()
+        t_dense = timeit(forward, net, repeat=repeat, device=device)
+        t_sparse = timeit(forward, sparse, repeat=repeat, device=device)
+        rows.append([
+            sparsity, sum(isinstance(m, ft.SparseLinear) for m in sparse.modules()),
+            1e3 * t_dense, 1e3 * t_sparse, t_dense / t_sparse, error,
+        ])
+    df = pd.DataFrame(rows, columns=[
+        "Zero weights", "CSR layers", "Dense (ms)", "sparseNet (ms)", "Speedup", "Max error",
+    ])
+    print("\nSparse inference, FairAutoEncoder {} features, n_hidden {}, batch size {}".format(
+        n_features, n_hidden, batch_size))
+    print(df.to_string(index=False))
+    return df
+
+
+def bench_lowrank(
+    eta_stars=(1, 5, 20, 50), n_features=500, n_hidden=300, batch_size=1000,
+    repeat=3, device="cpu", seed=0, tol=1e-4
+):
+    """FairAutoEncoder projected with proj_nuclear (projectNet, radius
+    ETA_STAR) vs the same net with the low rank layers factorized
+    (ft.lowRankNet): parameters, flops per sample of the Linear layers and
+    inference time of a batch. Raises AssertionError when the predictions of
+    the two nets differ by more than tol (relative to the largest prediction).
+    """
+    torch.manual_seed(seed)
+    x = torch.randn(batch_size, n_features, device=device)
+
+    def forward(net):
+        with torch.no_grad():
+            net(x)
+
+    def flops(net):
+        return sum(2 * m.in_features * m.out_features for m in net.modules()
+                   if isinstance(m, torch.nn.Linear))
+
+    rows = []
+    for eta_star in eta_stars:
+        net = ft.FairAutoEncoder(n_features, 1, n_hidden, activation="silu").to(device)
+        ft.projectNet(net, ft.proj_nuclear, 1, ETA_STAR=eta_star, device=device)
+        lowrank = ft.lowRankNet(net)
+        net.eval()
+        lowrank.eval()
+        with torch.no_grad():  # also warms up both nets
+            dense_pred = net(x)
+            error = (dense_pred - lowrank(x)).abs().max().item()
+        scale = max(1.0, dense_pred.abs().max().item())
+        assert error <= tol * scale, (
+            "lowRankNet: predictions differ by {} from the dense net at ETA_STAR {}".format(
+                error, eta_star))
+        t_dense = timeit(forward, net, repeat=repeat, device=device)
+        t_lowrank = timeit(forward, lowrank, repeat=repeat, device=device)
+        rows.append([
+            eta_star,
+            ",".join(str(m.factor_in.out_features) for m in lowrank.modules()
+                     if isinstance(m, ft.LowRankLinear)),
+            sum(p.numel() for p in net.parameters()),
+            sum(p.numel() for p in lowrank.parameters()),
+            flops(net), flops(lowrank),
+            1e3 * t_dense, 1e3 * t_lowrank, t_dense / t_lowrank, error,
+        ])
+    df = pd.DataFrame(rows, columns=[
+        "ETA_STAR", "Ranks", "Parameters", "Low rank parameters", "Flops",
+        "Low rank flops", "Dense (ms)", "Low rank (ms)", "Speedup", "Max error",
+    ])
+    print("\nLow rank layers after proj_nuclear, FairAutoEncoder {} features, "
+          "n_hidden {}, batch size {}".format(n_features, n_hidden, batch_size))
+    print(df.to_string(index=False))
+    return df
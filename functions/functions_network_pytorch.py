@@ -7,6 +7,11 @@ def weights_and_sparsity(model, tol=1.0e-3):
     respectively from the model, and return two dict type results.
     """
     state = model.state_dict()
+    # first layer of a compact net over all the input features
+    state.update({
+        name + ".weight": module.fullWeight()
+        for name, module in model.named_modules() if hasattr(module, "fullWeight")
+    })
     weights = {}
     spsty = {}
     for key in state.keys():
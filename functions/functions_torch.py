@@ -36,7 +36,53 @@ from captum.attr import (
 # ===========================================================================
 
 
-def proj_l1ball(w0, eta, device="cpu"):
+# Above this size, proj_l1ball(method="auto") uses the pivot algorithm
+# instead of the full sort (crossover measured with bench_l1ball). The pivot
+# and topk thresholds are sums in another order than the cumsum of the sort:
+# the projections agree with the sort up to a few float ulps (about 1e-6 in
+# float32, see bench_l1ball), not bit for bit, hence sort stays the default
+L1BALL_SORT_MAX = 4096
+
+
+def _l1ball_threshold_pivot(a, eta):
+    """Threshold of the l1 ball projection of a = |w| (1D) in expected linear time.
+    Active-set pivoting (Michelot / Condat): the candidate threshold
+    (sum(active) - eta) / |active| only increases, entries below it are discarded
+    until the active set is stable. Each pass is one vectorized O(|active|) sweep.
+    """
+    v = a
+    tau = (torch.sum(v) - eta) / v.numel()
+    while True:
+        v = v[v > tau]
+        if v.numel() == 0:  # eta below the float resolution of max(a)
+            break
+        tau_new = (torch.sum(v) - eta) / v.numel()
+        if tau_new <= tau:
+            break
+        tau = tau_new
+    return tau
+
+
+def _l1ball_threshold_topk(a, eta, k=64):
+    """Threshold of the l1 ball projection of a = |w| (1D) using a partial
+    selection of the k largest entries, k doubles until the next entry cannot
+    be active (then no further entry can raise the threshold). Fast when few
+    entries survive the projection.
+    """
+    n = a.numel()
+    while True:
+        k = min(k, n)
+        X = torch.topk(a, k, sorted=True).values
+        T = (torch.cumsum(X, dim=0) - eta) / torch.arange(
+            start=1, end=k + 1, device=a.device, dtype=a.dtype
+        )
+        j = torch.argmax(T)
+        if k == n or X[k - 1] <= T[j]:
+            return T[j]
+        k *= 2
+
+
+def proj_l1ball(w0, eta, device="cpu", method="sort"):
     # To help you understand, this function will perform as follow:
     #    a1 = torch.cumsum(torch.sort(torch.abs(y),dim = 0,descending=True)[0],dim=0)
     #    a2 = (a1 - eta)/(torch.arange(start=1,end=y.shape[0]+1))
@@ -44,6 +90,11 @@ def proj_l1ball(w0, eta, device="cpu"):
     #    a4 = torch.max(a3,torch.zeros_like(y))
     #    a5 = a4*torch.sign(y)
     #    return a5
+    #
+    # method: "sort" (default, O(n log n) sort + cumsum), "pivot" (expected
+    # linear time), "topk" (partial selection, fast when few entries survive)
+    # or "auto" (sort for small vectors, pivot above L1BALL_SORT_MAX entries).
+    # pivot, topk and auto match sort up to float rounding only (L1BALL_SORT_MAX)
 
     w = torch.as_tensor(w0, dtype=torch.get_default_dtype(), device=device)
 
@@ -53,31 +104,50 @@ def proj_l1ball(w0, eta, device="cpu"):
         init_shape = w.size()
         w = w.reshape(-1)
 
-    Res = torch.sign(w) * torch.max(
-        torch.abs(w)
-        - torch.max(
-            torch.cat(
-                (
+    if method == "auto":
+        method = "sort" if w.numel() <= L1BALL_SORT_MAX else "pivot"
+
+    if method == "sort":
+        Res = torch.sign(w) * torch.max(
+            torch.abs(w)
+            - torch.max(
+                torch.cat(
                     (
-                        torch.cumsum(
-                            torch.sort(torch.abs(w), dim=0, descending=True)[0],
-                            dim=0,
-                            dtype=torch.get_default_dtype(),
+                        (
+                            torch.cumsum(
+                                torch.sort(torch.abs(w), dim=0, descending=True)[0],
+                                dim=0,
+                                dtype=torch.get_default_dtype(),
+                            )
+                            - eta
                         )
-                        - eta
+                        / torch.arange(
+                            start=1,
+                            end=w.numel() + 1,
+                            device=device,
+                            dtype=torch.get_default_dtype(),
+                        ),
+                        torch.tensor([0.0], dtype=torch.get_default_dtype(), device=device),
                     )
-                    / torch.arange(
-                        start=1,
-                        end=w.numel() + 1,
-                        device=device,
-                        dtype=torch.get_default_dtype(),
-                    ),
-                    torch.tensor([0.0], dtype=torch.get_default_dtype(), device=device),
                 )
-            )
-        ),
-        torch.zeros_like(w),
-    )
+            ),
+            torch.zeros_like(w),
+        )
+    elif method == "pivot" or method == "topk":
+        a = torch.abs(w)
+        if w.numel() == 0 or torch.sum(a) <= eta:
+            theta = 0.0
+        elif eta <= 0:  # zero, as the sort method
+            theta = torch.max(a)
+        elif method == "pivot":
+            theta = _l1ball_threshold_pivot(a, eta)
+        else:
+            theta = _l1ball_threshold_topk(a, eta)
+        Res = torch.sign(w) * torch.clamp(a - theta, min=0)
+    else:
+        raise ValueError(
+            "proj_l1ball method '{}' is not one of 'auto', 'sort', 'pivot', 'topk'".format(method)
+        )
 
     Q = Res.reshape(init_shape).clone().detach()
 
@@ -4,7 +4,18 @@
 @author: Nolwenn Peyratout 
 """
 
+import copy
+import hashlib
+import io
+import itertools
+import mmap
+import os
+import queue
+import shutil
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib as mpl
@@ -19,7 +30,8 @@ import scipy.stats as sc
 from sklearn.model_selection import KFold
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
-from sklearn.metrics import mean_squared_error
+from sklearn.metrics import mean_squared_error, mean_absolute_error
+from scipy.stats import wasserstein_distance
 from torch.multiprocessing import Pool
 from matplotlib.colors import ListedColormap
 from sklearn.model_selection import train_test_split
@@ -37,6 +49,17 @@ except ImportError:
         "Use '!pip install captum' to install captum; '!pip install shap' to install shap"
     )
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the parquet files
+    pq = None
+
 from captum.attr import (
     GradientShap,
     DeepLift,
@@ -48,7 +71,53 @@ from captum.attr import (
 # ===========================================================================
 
 
-def proj_l1ball(w0, eta, device="cpu"):
+# Above this size, proj_l1ball(method="auto") uses the pivot algorithm
+# instead of the full sort (crossover measured with bench_l1ball). The pivot
+# and topk thresholds are sums in another order than the cumsum of the sort:
+# the projections agree with the sort up to a few float ulps (about 1e-6 in
+# float32, see bench_l1ball), not bit for bit, hence sort stays the default
+L1BALL_SORT_MAX = 4096
+
+
+def _l1ball_threshold_pivot(a, eta):
+    """Threshold of the l1 ball projection of a = |w| (1D) in expected linear time.
+    Active-set pivoting (Michelot / Condat): the candidate threshold
+    (sum(active) - eta) / |active| only increases, entries below it are discarded
+    until the active set is stable. Each pass is one vectorized O(|active|) sweep.
+    """
+    v = a
+    tau = (torch.sum(v) - eta) / v.numel()
+    while True:
+        v = v[v > tau]
+        if v.numel() == 0:  # eta below the float resolution of max(a)
+            break
+        tau_new = (torch.sum(v) - eta) / v.numel()
+        if tau_new <= tau:
+            break
+        tau = tau_new
+    return tau
+
+
+def _l1ball_threshold_topk(a, eta, k=64):
+    """Threshold of the l1 ball projection of a = |w| (1D) using a partial
+    selection of the k largest entries, k doubles until the next entry cannot
+    be active (then no further entry can raise the threshold). Fast when few
+    entries survive the projection.
+    """
+    n = a.numel()
+    while True:
+        k = min(k, n)
+        X = torch.topk(a, k, sorted=True).values
+        T = (torch.cumsum(X, dim=0) - eta) / torch.arange(
+            start=1, end=k + 1, device=a.device, dtype=a.dtype
+        )
+        j = torch.argmax(T)
+        if k == n or X[k - 1] <= T[j]:
+            return T[j]
+        k *= 2
+
+
+def proj_l1ball(w0, eta, device="cpu", method="sort"):
     # To help you understand, this function will perform as follow:
     #    a1 = torch.cumsum(torch.sort(torch.abs(y),dim = 0,descending=True)[0],dim=0)
     #    a2 = (a1 - eta)/(torch.arange(start=1,end=y.shape[0]+1))
@@ -56,6 +125,11 @@ def proj_l1ball(w0, eta, device="cpu"):
     #    a4 = torch.max(a3,torch.zeros_like(y))
     #    a5 = a4*torch.sign(y)
     #    return a5
+    #
+    # method: "sort" (default, O(n log n) sort + cumsum), "pivot" (expected
+    # linear time), "topk" (partial selection, fast when few entries survive)
+    # or "auto" (sort for small vectors, pivot above L1BALL_SORT_MAX entries).
+    # pivot, topk and auto match sort up to float rounding only (L1BALL_SORT_MAX)
 
     w = torch.as_tensor(w0, dtype=torch.get_default_dtype(), device=device)
 
@@ -65,31 +139,50 @@ def proj_l1ball(w0, eta, device="cpu"):
         init_shape = w.size()
         w = w.reshape(-1)
 
-    Res = torch.sign(w) * torch.max(
-        torch.abs(w)
-        - torch.max(
-            torch.cat(
-                (
+    if method == "auto":
+        method = "sort" if w.numel() <= L1BALL_SORT_MAX else "pivot"
+
+    if method == "sort":
+        Res = torch.sign(w) * torch.max(
+            torch.abs(w)
+            - torch.max(
+                torch.cat(
                     (
-                        torch.cumsum(
-                            torch.sort(torch.abs(w), dim=0, descending=True)[0],
-                            dim=0,
-                            dtype=torch.get_default_dtype(),
+                        (
+                            torch.cumsum(
+                                torch.sort(torch.abs(w), dim=0, descending=True)[0],
+                                dim=0,
+                                dtype=torch.get_default_dtype(),
+                            )
+                            - eta
                         )
-                        - eta
+                        / torch.arange(
+                            start=1,
+                            end=w.numel() + 1,
+                            device=device,
+                            dtype=torch.get_default_dtype(),
+                        ),
+                        torch.tensor([0.0], dtype=torch.get_default_dtype(), device=device),
                     )
-                    / torch.arange(
-                        start=1,
-                        end=w.numel() + 1,
-                        device=device,
-                        dtype=torch.get_default_dtype(),
-                    ),
-                    torch.tensor([0.0], dtype=torch.get_default_dtype(), device=device),
                 )
-            )
-        ),
-        torch.zeros_like(w),
-    )
+            ),
+            torch.zeros_like(w),
+        )
+    elif method == "pivot" or method == "topk":
+        a = torch.abs(w)
+        if w.numel() == 0 or torch.sum(a) <= eta:
+            theta = 0.0
+        elif eta <= 0:  # zero, as the sort method
+            theta = torch.max(a)
+        elif method == "pivot":
+            theta = _l1ball_threshold_pivot(a, eta)
+        else:
+            theta = _l1ball_threshold_topk(a, eta)
+        Res = torch.sign(w) * torch.clamp(a - theta, min=0)
+    else:
+        raise ValueError(
+            "proj_l1ball method '{}' is not one of 'auto', 'sort', 'pivot', 'topk'".format(method)
+        )
 
     Q = Res.reshape(init_shape).clone().detach()
 
@@ -106,20 +199,13 @@ def proj_l21ball(w2, eta, device="cpu"):
         Q = proj_l1ball(w, eta, device=device)
     else:
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
-
-        W = torch.tensor(
-            [torch.sum(torch.abs(w[:, i])).data.item() for i in range(ncol)]
-        )
+        W = sum_abs_batch(w, dim=0)
 
-        PW = proj_l1ball(W, eta, device=device)
+        PW = proj_l1ball(W, eta, device=w.device)
 
-        for i in range(ncol):
-            Res[:, i] = proj_l2ball(w[:, i], PW[i].data.item(), device=device)
+        Res = proj_l2ball_batch(w, PW, dim=0)
 
-        Q = Res.clone().detach().requires_grad_(True)
+        Q = Res.detach().requires_grad_(True)
 
     if not torch.is_tensor(w2):
         Q = Q.data.numpy()
@@ -135,6 +221,43 @@ def proj_l2ball(w0, eta, device="cpu"):
     return torch.mul(eta / n, w)
 
 
+def proj_l1ball_batch(w, eta, dim=0):
+    """Project every column (dim=0) or row (dim=1) of the matrix w on the l1 ball
+    of its own radius eta[i], in a single sort/cumsum pass over the matrix.
+    Same computation as proj_l1ball(method="sort") applied slice by slice; the
+    slices are made contiguous so that the reductions run in the same order.
+    """
+    if dim == 0:
+        return proj_l1ball_batch(w.T.contiguous(), eta, dim=1).T.contiguous()
+    eta = torch.as_tensor(eta, dtype=w.dtype, device=w.device)
+    A = torch.abs(w)
+    T = (
+        torch.cumsum(torch.sort(A, dim=1, descending=True)[0], dim=1)
+        - eta.unsqueeze(1)
+    ) / torch.arange(start=1, end=w.shape[1] + 1, device=w.device, dtype=w.dtype)
+    theta = torch.clamp(torch.amax(T, dim=1, keepdim=True), min=0)
+    return torch.sign(w) * torch.clamp(A - theta, min=0)
+
+
+def sum_abs_batch(w, dim=0):
+    """l1 norm of every column (dim=0) or row (dim=1) of the matrix w,
+    reduced in the same order as torch.sum on each slice
+    """
+    if dim == 0:
+        w = w.T.contiguous()
+    return torch.sum(torch.abs(w), dim=1)
+
+
+def proj_l2ball_batch(w, eta, dim=0):
+    """Project every column (dim=0) or row (dim=1) of the matrix w on the l2 ball
+    of its own radius eta[i]
+    """
+    eta = torch.as_tensor(eta, dtype=w.dtype, device=w.device).unsqueeze(dim)
+    n = torch.linalg.norm(w, ord=2, dim=dim, keepdim=True)
+    # eta / n as computed by proj_l2ball (python float / tensor)
+    return torch.where(n <= eta, w, torch.mul(torch.reciprocal(n) * eta, w))
+
+
 ## fold in ["local","full",partial"]
 def proj_nuclear(w0, eta_star, fold="local", device="cpu"):
 
@@ -184,20 +307,13 @@ def proj_l11ball(w2, eta, device="cpu"):
         Q = proj_l1ball(w, eta, device=device)
     else:
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
-
-        W = torch.tensor(
-            [torch.sum(torch.abs(w[:, i])).data.item() for i in range(ncol)]
-        )
+        W = sum_abs_batch(w, dim=0)
 
-        PW = proj_l1ball(W, eta, device=device)
+        PW = proj_l1ball(W, eta, device=w.device)
 
-        for i in range(ncol):
-            Res[:, i] = proj_l1ball(w[:, i], PW[i].data.item(), device=device)
+        Res = proj_l1ball_batch(w, PW, dim=0)
 
-        Q = Res.clone().detach().requires_grad_(True)
+        Q = Res.detach().requires_grad_(True)
 
     if not torch.is_tensor(w2):
         Q = Q.data.numpy()
@@ -212,20 +328,13 @@ def proj_l11ball_line(w2, eta, device="cpu"):
         Q = proj_l1ball(w, eta, device=device)
     else:
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
+        W = sum_abs_batch(w, dim=1)
 
-        W = torch.tensor(
-            [torch.sum(torch.abs(w[i, :])).data.item() for i in range(nrow)]
-        )
-
-        PW = proj_l1ball(W, eta, device=device)
+        PW = proj_l1ball(W, eta, device=w.device)
 
-        for i in range(nrow):
-            Res[i, :] = proj_l1ball(w[i, :], PW[i].data.item(), device=device)
+        Res = proj_l1ball_batch(w, PW, dim=1)
 
-        Q = Res.clone().detach().requires_grad_(True)
+        Q = Res.detach().requires_grad_(True)
 
     if not torch.is_tensor(w2):
         Q = Q.data.numpy()
@@ -234,33 +343,30 @@ def proj_l11ball_line(w2, eta, device="cpu"):
 
 
 
-def bilevel_proj_l1Inftyball(w2, eta, device="cpu"):
+def bilevel_proj_l1Inftyball(w2, eta, device="cpu", AXIS=1):
+    """Bilevel l1,inf projection: the vector of maxima (per column if AXIS=1,
+    per row if AXIS=0) is projected on the l1 ball of radius eta, then every
+    column (row) is clamped to its projected maximum.
+    Fully tensorized: one amax reduction, one l1 projection, one broadcast clamp.
+    """
 
     w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
 
     if w.dim() == 1:
         Q = proj_l1ball(w, eta, device=device)
     else:
+        dim = 0 if AXIS else 1
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
-
-        W = torch.tensor(
-            [torch.max(torch.abs(w[:, i])).data.item() for i in range(ncol)]
-        )
+        W = torch.amax(torch.abs(w), dim=dim)
 
-        PW = proj_l1ball(W, eta, device=device)
+        PW = proj_l1ball(W, eta, device=w.device)
 
-        for i in range(ncol):
-            Res[:, i] = torch.clamp(torch.abs(w[:, i]), max=PW[i].data.item())
-            Res[:, i] = Res[:, i].to(device) * torch.sign(w[:, i]).to(device)
+        Res = torch.clamp(torch.abs(w), max=PW.unsqueeze(dim)) * torch.sign(w)
 
-        Q = Res.clone().detach().requires_grad_(True)
+        Q = Res.detach().requires_grad_(True)
 
     if not torch.is_tensor(w2):
         Q = Q.data.numpy()
-    
 
     return Q
 
@@ -268,6 +374,83 @@ def bilevel_proj_l1Inftyball(w2, eta, device="cpu"):
 
 
 
+def bilevel_proj_l1Inftyball_path(w2, ETAS, device="cpu", AXIS=1, tol=1.0e-3, return_proj=False):
+    """Bilevel l1,inf projection of the matrix w2 for a whole grid of radii ETAS.
+    The maxima are sorted and summed once; the l1 threshold of every radius is
+    then read with a binary search: with X the sorted maxima and S = cumsum(X),
+    D[j] = S[j] - (j + 1) X[j] is nondecreasing and the rho = #{D < eta} largest
+    maxima survive, theta = (S[rho - 1] - eta) / rho.
+
+    Attributes:
+        w2: Tensor or numpy - weight matrix.
+        ETAS: list - projection radii.
+        AXIS: int - 1 for columns (features), 0 for rows (neurons).
+        tol: Scalar - the threshold to select zeros (as in sparsity_col).
+        return_proj: bool - also return the projected matrices.
+
+    Returns:
+        support: Tensor (len(ETAS), n) bool - columns (rows if AXIS=0) with an
+            entry above tol.
+        sparsity: numpy (len(ETAS),) - sparsity (%) as given by sparsity_col
+            (sparsity_line if AXIS=0) on the projected matrices.
+        Q: list of the projected matrices if return_proj, else None.
+    """
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+    dim = 0 if AXIS else 1
+
+    W = torch.amax(torch.abs(w), dim=dim)
+    etas = torch.as_tensor(ETAS, dtype=w.dtype, device=w.device).reshape(-1)
+
+    X = torch.sort(W, descending=True)[0]
+    S = torch.cumsum(X, dim=0)
+    j = torch.arange(start=1, end=W.numel() + 1, device=w.device, dtype=w.dtype)
+    D = torch.cummax(S - j * X, dim=0)[0]
+    rho = torch.clamp(torch.searchsorted(D, etas), min=1)
+    theta = torch.clamp((S[rho - 1] - etas) / rho, min=0)
+
+    PW = torch.clamp(W.unsqueeze(0) - theta.unsqueeze(1), min=0)
+    # an entry of column j survives the threshold tol iff min(|w_ij|, PW_j) >= tol
+    support = PW >= tol
+    sparsity = (1.0 - support.sum(1).cpu().numpy() / W.numel()) * 100
+
+    Q = None
+    if return_proj:
+        Q = [
+            torch.clamp(torch.abs(w), max=PW[e].unsqueeze(dim)) * torch.sign(w)
+            for e in range(len(etas))
+        ]
+        if not torch.is_tensor(w2):
+            Q = [q.cpu().numpy() for q in Q]
+
+    return support, sparsity, Q
+
+
+def eta_for_target_features(w2, k, AXIS=1, tol=1.0e-3, device="cpu"):
+    """Radius ETA for which bilevel_proj_l1Inftyball keeps exactly k columns
+    (rows if AXIS=0) of w2 with an entry above tol, computed from the sorted
+    maxima in O(d.log(d)).
+    With X the maxima sorted in descending order, the threshold theta = X[k]
+    zeroes every column but the k largest, and eta = sum(max(X - theta, 0)).
+    When X[k - 1] - X[k] < 2 * tol, theta is lowered to the middle of the
+    interval where the k-th column stays above tol and the next ones below it.
+    Ties between the k-th and (k+1)-th maxima cannot be separated.
+    """
+    w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
+    dim = 0 if AXIS else 1
+
+    W = torch.amax(torch.abs(w), dim=dim)
+    X = torch.sort(W, descending=True)[0]
+    if not 1 <= k <= X.numel():
+        raise ValueError(
+            "the number of features to keep must be between 1 and {}, got {}".format(
+                X.numel(), k)
+        )
+    if k == X.numel():
+        return torch.sum(X).item()
+    theta = torch.clamp(torch.minimum(X[k], (X[k - 1] + X[k]) / 2 - tol), min=0)
+    return torch.sum(torch.clamp(X - theta, min=0)).item()
+
+
 from torch.multiprocessing import Pool
 
 def f1(i, w):
@@ -277,54 +460,48 @@ def f2(i, w, PW):
 
 
 def proj_l1Inftyball_line(w2, C, device="cpu"):
+    """l1,inf projection {sum_j max_i |X(i,j)| <= C} by the active set
+    algorithm over the columns, tensorized: for a given theta every active
+    column advances its index k[j] at once, then theta is recomputed from the
+    active columns until it stops changing.
+    """
 
     w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
-    # w = torch.as_tensor(w2, device=device)
 
     if w.dim() == 1:
         Q = proj_l1ball(w, C, device=device)
     else:
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
+        nrow, ncol = w.shape[0:2]
 
         X = torch.abs(w)
         X = torch.sort(X, 0, True).values
         S = torch.cumsum(X, 0)
 
-        k = [0 for _ in range(ncol)]
-        a = [j for j in range(ncol)]
-        theta_num = sum([X[0, i] for i in range(ncol)])
-        theta_den = ncol
-        theta = (theta_num - C) / theta_den
-        changed = True
-        while changed:
-            for j in a:
-                i = k[j]
-                while i < nrow - 1 and (S[i, j] - theta) / (i + 1) < X[i + 1, j]:
-                    i += 1
-                theta_num -= S[k[j], j] / (k[j] + 1)
-                theta_den -= 1.0 / (k[j] + 1)
-                k[j] = i
-                if i == nrow - 1 and S[i, j] < theta:
-                    a.remove(j)
-                    continue
-                theta_num += S[k[j], j] / (k[j] + 1)
-                theta_den += 1.0 / (k[j] + 1)
+        cols = torch.arange(ncol, device=w.device)
+        rows = torch.arange(nrow - 1, device=w.device).unsqueeze(1)
+        stop = torch.ones((1, ncol), dtype=torch.bool, device=w.device)
+        k = torch.zeros(ncol, dtype=torch.long, device=w.device)
+        a = torch.ones(ncol, dtype=torch.bool, device=w.device)
+        theta = (torch.sum(X[0]) - C) / ncol
+        while True:
+            # k[j] moves to the first i >= k[j] where
+            # (S[i, j] - theta) / (i + 1) < X[i + 1, j] fails (nrow - 1 if none)
+            advance = (((S[:-1] - theta) / (rows + 1)) < X[1:]) | (rows < k)
+            k = torch.where(a, torch.argmax(torch.cat((~advance, stop)).to(torch.uint8), 0), k)
+            Sk = S[k, cols]
+            a = a & ~((k == nrow - 1) & (Sk < theta))
+            theta_num = torch.sum(torch.where(a, Sk / (k + 1), 0.0))
+            theta_den = torch.sum(torch.where(a, 1.0 / (k + 1), 0.0))
             theta_prime = (theta_num - C) / theta_den
-            changed = theta_prime != theta
+            if theta_prime == theta:
+                break
             theta = theta_prime
 
-        Q = w.clone()
-        for j in range(ncol):
-            if S[-1, j] < theta:
-                Q[:, j] = 0
-            else:
-                mu = (S[k[j], j] - theta) / (k[j] + 1)
-                Q[:, j] = torch.min(mu, abs(Q[:, j]))
+        mu = (S[k, cols] - theta) / (k + 1)
+        Q = torch.where(S[-1] < theta, torch.zeros_like(w), torch.minimum(torch.abs(w), mu))
         Q = Q * torch.sign(w)
-        Q = Q.clone().detach().requires_grad_(True)
+        Q = Q.detach().requires_grad_(True)
 
         #print("Theta = " + str(theta))
     if not torch.is_tensor(w2):
@@ -333,11 +510,12 @@ def proj_l1Inftyball_line(w2, C, device="cpu"):
 
 def proj_l1Inftyball_line_unbounded(w2, C, device="cpu"):
     w = torch.as_tensor(w2, dtype=torch.get_default_dtype(), device=device)
-    Q = proj_l1Inftyball_line(w2, C, device)
-    if w.dim() == 1:
-        return Q
-    else:
-        return torch.abs(w) * torch.sign(Q)
+    Q = proj_l1Inftyball_line(w, C, device)
+    if w.dim() > 1:
+        Q = torch.abs(w) * torch.sign(Q)
+    if not torch.is_tensor(w2):
+        Q = Q.data.numpy()
+    return Q
 
 
 def proj_l12ball(V, eta, axis=1, threshold=0.001, device="cpu"):
@@ -394,6 +572,50 @@ def proj_l12ball(V, eta, axis=1, threshold=0.001, device="cpu"):
     return W.float()
 
 
+def _proj_l1inf_sorted(Y, X, S, c, tol=1e-5):
+    """Core of proj_l1inf_numpy on a 2D array Y (projection of the rows),
+    given X = |Y| sorted in descending order along the rows and S = cumsum(X).
+    """
+    v = np.sum(X[:, 0])
+    if v <= c:
+        # inside the ball
+        X = Y
+    else:
+        N, M = Y.shape
+        idx = np.ones((N, 1), dtype=int)
+        theta = (v - c) / N
+        mu = np.zeros((N, 1))
+        active = np.ones((N, 1))
+        theta_old = 0
+        while np.abs(theta_old - theta) > tol:
+            # All active rows advance at once: for a given theta the test
+            # (S[n, j - 1] - theta) / j < X[n, j] holds for j below a row
+            # dependent index and fails after it, so the first failing j >= idx[n]
+            # is found by a vectorized bisection over the precomputed cumsums.
+            n = np.flatnonzero(active[:, 0])
+            lo = idx[n, 0]
+            hi = np.full(n.shape, M)
+            searching = lo < hi
+            while np.any(searching):
+                j = np.minimum((lo + hi) // 2, M - 1)
+                cont = ((S[n, j - 1] - theta) / j) < X[n, j]
+                lo = np.where(searching & cont, j + 1, lo)
+                hi = np.where(searching & ~cont, j, hi)
+                searching = lo < hi
+            j = lo
+            idx[n, 0] = j
+            mu[n, 0] = S[n, j - 1] / j
+            dead = n[(j == M) & ((mu[n, 0] - (theta / j)) <= 0)]
+            active[dead] = 0
+            mu[dead] = 0
+            theta_old = theta
+            theta = (np.sum(mu) - c) / (np.sum(active / idx))
+        X = np.minimum(np.abs(Y), (mu - theta / idx) * active)
+        X = X * np.sign(Y)
+
+    return X
+
+
 def proj_l1inf_numpy(Y, c, tol=1e-5, direction="row"):
     """
     {X : sum_n max_m |X(n,m)| <= c}
@@ -412,6 +634,10 @@ def proj_l1inf_numpy(Y, c, tol=1e-5, direction="row"):
     Its worst case complexity, never found in practice, is
     O(NM.log(M) + N^2.M).
 
+    Each theta update advances all the active rows together (vectorized
+    bisection on the cumsums, O(N.log(M)) per update) instead of looping
+    over the rows in Python.
+
     Note : This is a numpy transcription of the original MATLAB code
     *Due to floating point errors, the actual implementation of the algorithm
     uses a tolerance parameter to guarantee halting of the program
@@ -427,33 +653,7 @@ def proj_l1inf_numpy(Y, c, tol=1e-5, direction="row"):
         added_dimension = True
 
     X = np.flip(np.sort(np.abs(Y), axis=1), axis=1)
-    v = np.sum(X[:, 0])
-    if v <= c:
-        # inside the ball
-        X = Y
-    else:
-        N, M = Y.shape
-        S = np.cumsum(X, axis=1)
-        idx = np.ones((N, 1), dtype=int)
-        theta = (v - c) / N
-        mu = np.zeros((N, 1))
-        active = np.ones((N, 1))
-        theta_old = 0
-        while np.abs(theta_old - theta) > tol:
-            for n in range(N):
-                if active[n]:
-                    j = idx[n]
-                    while (j < M) and ((S[n, j - 1] - theta) / j) < X[n, j]:
-                        j += 1
-                    idx[n] = j
-                    mu[n] = S[n, j - 1] / j
-                    if j == M and (mu[n] - (theta / j)) <= 0:
-                        active[n] = 0
-                        mu[n] = 0
-            theta_old = theta
-            theta = (np.sum(mu) - c) / (np.sum(active / idx))
-        X = np.minimum(np.abs(Y), (mu - theta / idx) * active)
-        X = X * np.sign(Y)
+    X = _proj_l1inf_sorted(Y, X, np.cumsum(X, axis=1), c, tol)
 
     if added_dimension:
         X = np.squeeze(X)
@@ -471,20 +671,13 @@ def bilevel_proj_l11ball(w2, eta, device="cpu"):
         Q = proj_l1ball(w, eta, device=device)
     else:
 
-        init_shape = w.shape
-        Res = torch.empty(init_shape)
-        nrow, ncol = init_shape[0:2]
-
-        W = torch.tensor(
-            [torch.sum(torch.abs(w[:, i])).data.item() for i in range(ncol)]
-        )
+        W = sum_abs_batch(w, dim=0)
 
-        PW = proj_l1ball(W, eta, device=device)
+        PW = proj_l1ball(W, eta, device=w.device)
 
-        for i in range(ncol):
-            Res[:, i] = proj_l1ball(w[:, i], PW[i].data.item(), device=device)
+        Res = proj_l1ball_batch(w, PW, dim=0)
 
-        Q = Res.clone().detach().requires_grad_(True)
+        Q = Res.detach().requires_grad_(True)
 
     if not torch.is_tensor(w2):
         Q = Q.data.numpy()
@@ -505,6 +698,36 @@ def proj_l1infball(w0, eta, AXIS=1, device="cpu", tol=1e-5):
     return Q
 
 
+def proj_l1infball_path(w0, ETAS, AXIS=1, device="cpu", tol=1e-5, tol_sparsity=1.0e-3, return_proj=False):
+    """Exact l1,inf projection (proj_l1infball) for a whole grid of radii ETAS,
+    sorting and summing |w0| once for all the radii.
+
+    Returns:
+        support: Tensor (len(ETAS), n) bool - columns (rows if AXIS=0) with an
+            entry above tol_sparsity.
+        sparsity: numpy (len(ETAS),) - sparsity (%) as given by sparsity_col
+            (sparsity_line if AXIS=0) on the projected matrices.
+        Q: list of the projected matrices if return_proj, else None.
+    """
+    w = torch.as_tensor(w0, dtype=torch.get_default_dtype()).detach().cpu().numpy()
+    Y = np.transpose(w) if AXIS else w
+
+    X = np.flip(np.sort(np.abs(Y), axis=1), axis=1)
+    S = np.cumsum(X, axis=1)
+
+    support = np.zeros((len(ETAS), Y.shape[0]), dtype=bool)
+    Q = [] if return_proj else None
+    for e, eta in enumerate(ETAS):
+        res = _proj_l1inf_sorted(Y, X, S, eta, tol)
+        support[e] = np.any(np.abs(res) >= tol_sparsity, axis=1)
+        if return_proj:
+            res = np.transpose(res) if AXIS else res
+            Q.append(torch.as_tensor(res, dtype=torch.get_default_dtype(), device=device))
+    sparsity = (1.0 - support.sum(1) / Y.shape[0]) * 100
+
+    return torch.as_tensor(support, device=device), sparsity, Q
+
+
 def full_fold_conv(M):
 
     if M.dim() > 2:
@@ -674,30 +897,301 @@ class LoadDataset(torch.utils.data.Dataset):
         return self.X[i], self.Y[i], self.ind[i]
 
 
-def CrossVal(X, Y, patient_name, BATCH_SIZE=32, nfold=0, seed=1):
-    kf = KFold(n_splits=4, shuffle=True, random_state=seed)
-    i = 0
-    for train_index, test_index in kf.split(X):
-        X_train, X_test = X[train_index], X[test_index]
-        y_train, y_test = np.array(Y)[train_index.astype(int)], np.array(Y)[test_index.astype(int)]
-        ind_train, ind_test = patient_name[train_index], patient_name[test_index]
-        dtrain = LoadDataset(X_train, y_train, ind_train)
-        # train_set, _ = torch.utils.data.random_split(dtrain, [1])
-        train_dl = torch.utils.data.DataLoader(
-            dtrain, batch_size=BATCH_SIZE, shuffle=True
+class FoldDataset(torch.utils.data.Dataset):
+    """Samples of a CrossValFolds store selected by index, without copy of the data
+
+    Attributes:
+        store: CrossValFolds - the data
+        index: LongTensor - rows of the samples in the store
+    """
+
+    def __init__(self, store, index):
+        super().__init__()
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        row = self.index[i]
+        return self.store.X[row], self.store.Y[row], self.store.patient_name[int(row)]
+
+    @property
+    def X(self):
+        return self.store.X[self.index]
+
+    @property
+    def Y(self):
+        return self.store.Y[self.index]
+
+    @property
+    def ind(self):
+        return self.store.patient_name[self.index.cpu().numpy()]
+
+
+class TensorLoader:
+    """Minibatch iterator over the tensors of a LoadDataset kept on the device,
+    replacing DataLoader: one randperm per epoch (shuffle), the batches are
+    slices of contiguous tensors, no per-sample collation. For a FoldDataset
+    the batches are gathered from the store by index.
+
+    Attributes:
+        dataset: LoadDataset or FoldDataset - the data
+        batch_size: int - number of samples of a batch
+        shuffle: bool - new random order at every epoch (global torch RNG)
+        device: str - where the batches are
+        return_names: bool - yield (x, labels, names) instead of (x, labels)
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, device="cpu",
+                 return_names=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.return_names = return_names
+        if isinstance(dataset, FoldDataset):
+            self.X = dataset.store.X.to(device)
+            self.Y = dataset.store.Y.to(device)
+            self.names = dataset.store.patient_name
+            self.index = dataset.index.to(device)
+        else:
+            self.X = dataset.X.to(device)
+            self.Y = dataset.Y.to(device)
+            self.names = dataset.ind
+            self.index = None
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        X, Y, index, order = self.X, self.Y, self.index, None
+        if self.shuffle:
+            order = torch.randperm(len(self.dataset))
+            if index is None:
+                X, Y = X[order.to(X.device)], Y[order.to(Y.device)]
+            else:
+                index = index[order.to(index.device)]
+        for start in range(0, len(self.dataset), self.batch_size):
+            end = start + self.batch_size
+            if index is None:
+                batch = (X[start:end], Y[start:end])
+                rows = order[start:end].tolist() if order is not None else None
+            else:
+                batch = (X[index[start:end]], Y[index[start:end]])
+                rows = index[start:end].tolist()
+            if not self.return_names:
+                yield batch
+            elif rows is None:
+                yield batch + (self.names[start:end],)
+            else:
+                yield batch + ([self.names[i] for i in rows],)
+
+
+class MemmapDataset(torch.utils.data.Dataset):
+    """Samples of an on-disk float32 array selected by index, for data that
+    do not fit in memory: only the labels and the names are kept in memory,
+    the rows of X are read from the file by MemmapLoader.
+
+    Attributes:
+        filename: str - .npy file of X (samples x features), e.g. the X.npy
+            of the ReadData cache
+        offset: int - position of the first row in the file
+        shape: tuple - shape of the whole array
+        index: numpy array - sorted rows of the samples in the array
+        Y: tensor - labels of the samples
+        ind: numpy array - names of the samples
+    """
+
+    def __init__(self, X, Y, patient_name, index=None):
+        if not isinstance(X, np.memmap):
+            X = np.load(X, mmap_mode="r")
+        if not (isinstance(X.base, mmap.mmap) and X.dtype == np.float32
+                and X.ndim == 2 and X.flags.c_contiguous):
+            raise ValueError("X must be a whole 2-d float32 .npy file opened with mmap_mode")
+        super().__init__()
+        self.filename = X.filename
+        self.offset = X.offset
+        self.shape = X.shape
+        self.index = np.arange(len(X)) if index is None else np.sort(np.asarray(index))
+        self.Y = torch.as_tensor(np.asarray(Y)[self.index], dtype=torch.float32)
+        self.ind = np.asarray(patient_name)[self.index]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return torch.from_numpy(self.readRows([i])[0]), self.Y[i], self.ind[i]
+
+    def readRows(self, rows):
+        """X of the samples rows (sorted), with a single read of their span"""
+        file_rows = self.index[rows]
+        n_features = self.shape[1]
+        span = np.fromfile(
+            self.filename,
+            dtype=np.float32,
+            count=(file_rows[-1] + 1 - file_rows[0]) * n_features,
+            offset=self.offset + int(file_rows[0]) * n_features * 4,
+        ).reshape(-1, n_features)
+        return span[file_rows - file_rows[0]]
+
+
+class MemmapLoader:
+    """Minibatch iterator over a MemmapDataset, used like TensorLoader: the
+    samples are read by blocks of block_size consecutive rows, shuffle
+    permutes the blocks and the samples within each block (global torch RNG,
+    drawn at the start of the epoch), and a background thread reads the next
+    prefetch blocks while the batches of the current one are trained. The
+    memory used is a few blocks whatever the number of samples.
+    The shuffle is local to the blocks: a batch only holds samples of one
+    block, so the batches differ from those of TensorLoader (a permutation of
+    all the samples) and the order of the rows in the file matters, shuffle
+    it beforehand if it is sorted. A block_size of at least the number of
+    samples gives a global shuffle.
+
+    Attributes:
+        dataset: MemmapDataset - the data
+        batch_size: int - number of samples of a batch
+        shuffle: bool - new random order at every epoch
+        device: str - where the batches are
+        return_names: bool - yield (x, labels, names) instead of (x, labels)
+        block_size: int - number of samples read at once
+        prefetch: int - number of blocks read ahead
+    """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False, device="cpu",
+                 return_names=False, block_size=8192, prefetch=2):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.return_names = return_names
+        self.block_size = max(block_size, batch_size)
+        self.prefetch = prefetch
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def plan(self):
+        """(rows, order) of the blocks of an epoch"""
+        starts = torch.arange(0, len(self.dataset), self.block_size)
+        if self.shuffle:
+            starts = starts[torch.randperm(len(starts))]
+        blocks = []
+        for start in starts.tolist():
+            rows = np.arange(start, min(start + self.block_size, len(self.dataset)))
+            order = torch.randperm(len(rows)).numpy() if self.shuffle else None
+            blocks.append((rows, order))
+        return blocks
+
+    @staticmethod
+    def putItem(ready, item, stop):
+        """Put item in the queue ready unless stop is set, return False if stopped"""
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readBlocks(self, blocks, ready, stop):
+        try:
+            for rows, order in blocks:
+                if stop.is_set():  # the consumer left the loop
+                    return
+                x = self.dataset.readRows(rows)
+                y, names = self.dataset.Y[rows], self.dataset.ind[rows]
+                if order is not None:
+                    x, y, names = x[order], y[torch.from_numpy(order)], names[order]
+                x = torch.from_numpy(x)
+                if "cuda" in str(self.device):
+                    x = x.pin_memory()
+                if not self.putItem(ready, (x, y, names), stop):
+                    return
+        except BaseException as error:  # raised again by __iter__
+            self.putItem(ready, error, stop)
+
+    def __iter__(self):
+        blocks = self.plan()
+        ready, stop = queue.Queue(maxsize=self.prefetch), threading.Event()
+        reader = threading.Thread(
+            target=self.readBlocks, args=(blocks, ready, stop), daemon=True
         )
-        dtest = LoadDataset(X_test, y_test, ind_test)
-        # _, test_set = torch.utils.data.random_split(dtest, [0])
-        test_dl = torch.utils.data.DataLoader(dtest, batch_size=1)
-        if i == nfold:
-            # for i, batch in enumerate(test_dl):
-            #     print(batch[0])
-            return train_dl, test_dl, len(dtrain), len(dtest), y_test
-        i += 1
+        reader.start()
+        try:
+            rest = None
+            for i in range(len(blocks)):
+                item = ready.get()
+                if isinstance(item, BaseException):
+                    raise item
+                x, y, names = item
+                if rest is not None:
+                    x, y = torch.cat((rest[0], x)), torch.cat((rest[1], y))
+                    names = np.concatenate((rest[2], names))
+                last = i == len(blocks) - 1
+                end = len(x) if last else len(x) // self.batch_size * self.batch_size
+                for start in range(0, end, self.batch_size):
+                    batch_end = min(start + self.batch_size, end)
+                    batch = (
+                        x[start:batch_end].to(self.device, non_blocking=True),
+                        y[start:batch_end].to(self.device, non_blocking=True),
+                    )
+                    yield batch + (list(names[start:batch_end]),) if self.return_names else batch
+                rest = None if last or end == len(x) else (x[end:], y[end:], names[end:])
+        finally:
+            stop.set()
+            reader.join()
+
+
+class CrossValFolds:
+    """Cross validation folds over a single float32 copy of the data: X and Y
+    are converted once to contiguous tensors on device, the KFold splits of a
+    seed are computed once and every fold is an index view of the store
+    (FoldDataset) read by TensorLoader.
+
+    Attributes:
+        X, Y: tensors - the data
+        patient_name: numpy array - sample names
+        nfolds: int - number of folds
+    """
+
+    def __init__(self, X, Y, patient_name, nfolds=4, device="cpu"):
+        self.X = torch.as_tensor(np.ascontiguousarray(X), dtype=torch.float32, device=device)
+        self.Y = torch.as_tensor(np.asarray(Y), dtype=torch.float32, device=device)
+        self.patient_name = np.asarray(patient_name)
+        self.nfolds = nfolds
+        self.device = device
+        self._splits = {}
+
+    def splits(self, seed):
+        """(train_index, test_index) of every fold of seed, as KFold"""
+        if seed not in self._splits:
+            kf = KFold(n_splits=self.nfolds, shuffle=True, random_state=seed)
+            self._splits[seed] = [
+                (torch.as_tensor(train_index, device=self.device),
+                 torch.as_tensor(test_index, device=self.device))
+                for train_index, test_index in kf.split(self.patient_name)
+            ]
+        return self._splits[seed]
+
+    def fold(self, seed, nfold, BATCH_SIZE=32):
+        """The loaders of CrossVal for fold nfold of seed"""
+        train_index, test_index = self.splits(seed)[nfold]
+        dtrain = FoldDataset(self, train_index)
+        dtest = FoldDataset(self, test_index)
+        train_dl = TensorLoader(dtrain, batch_size=BATCH_SIZE, shuffle=True, device=self.device)
+        test_dl = TensorLoader(dtest, batch_size=1, device=self.device, return_names=True)
+        y_test = self.Y[test_index].cpu().numpy()
+        return train_dl, test_dl, len(dtrain), len(dtest), y_test
+
+
+def CrossVal(X, Y, patient_name, BATCH_SIZE=32, nfold=0, seed=1, device="cpu"):
+    return CrossValFolds(X, Y, patient_name, device=device).fold(seed, nfold, BATCH_SIZE)
         
-def TestSet(X, Y, patient_name, BATCH_SIZE=32):
+def TestSet(X, Y, patient_name, BATCH_SIZE=32, device="cpu"):
     dtest = LoadDataset(X, Y, patient_name)
-    test_dl = torch.utils.data.DataLoader(dtest, batch_size=1)
+    test_dl = TensorLoader(dtest, batch_size=1, device=device, return_names=True)
     return test_dl, len(dtest)
     
     
@@ -1016,6 +1510,36 @@ def figPerAge(true, pred, seed, fold_idx):
 
  
 
+class PredictionCollector:
+    """Predictions of a loop written into a buffer preallocated for n_samples
+    rows at the first batch: each row is the detached outputs of the net
+    followed by the label (the data_encoder of the training loops and runBestNet).
+
+    Attributes:
+        n_samples: int - number of samples of the loop
+    """
+
+    def __init__(self, n_samples):
+        self.n_samples = n_samples
+        self.data = None
+        self.n = 0
+
+    def add(self, encoder_out, labels):
+        encoder_out = encoder_out.detach().view(len(labels), -1)
+        if self.data is None:
+            self.data = torch.empty(
+                self.n_samples, encoder_out.shape[1] + 1,
+                dtype=encoder_out.dtype, device=encoder_out.device,
+            )
+        rows = slice(self.n, self.n + len(labels))
+        self.data[rows, :-1] = encoder_out
+        self.data[rows, -1] = labels
+        self.n += len(labels)
+
+    def result(self):
+        return self.data[: self.n]
+
+
 def RunFCNNNoProj(
     net: nn.Module,
     criterion_regression,
@@ -1034,6 +1558,8 @@ def RunFCNNNoProj(
     N_EPOCHS=30,
     AXIS=0,
     typeEpoch=None,
+    netName=None,
+    VAL_EVERY=1,
 
 ):
     """Full Autoencoder training loop
@@ -1044,12 +1570,12 @@ def RunFCNNNoProj(
         The neural network to train and evaluate
     criterion_regression : loss module
         The classification loss component
-    train_dl : DataLoader
-        Training DataLoader
+    train_dl : TensorLoader, MemmapLoader or DataLoader
+        Training loader
     train_len : int
         Number of samples in the training set
-    test_dl : DataLoader
-        Testing/Evaluation DataLoader
+    test_dl : TensorLoader, MemmapLoader or DataLoader
+        Testing/Evaluation loader
     test_len : int
         Number of samples in the testing set
     optimizer : Optimizer
@@ -1062,10 +1588,17 @@ def RunFCNNNoProj(
         Number of epochs for training, by default 30
     AXIS : int, optional
         The projection axis, by default 0
+    netName : str, optional
+        File name of the best net in outputPath, by default
+        bestNetName(seed, fold_idx, typeEpoch)
+    VAL_EVERY : int, optional
+        Validate (and track the best net) every VAL_EVERY epochs and at the
+        last epoch, by default 1
 
     Returns
     -------
-    data_encoder, epoch_loss, best_test, net
+    data_encoder, epoch_loss, best_test, net, best_state
+        best_state is the state_dict of the best epoch (see snapshotNet)
     """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     epoch_loss,  train_time = (
@@ -1076,6 +1609,9 @@ def RunFCNNNoProj(
         epoch_val_loss
     ) = ([])
     best_test = np.inf 
+    best_state = None
+    x_val, labels_val = validationData(test_dl, device)
+    predictions = PredictionCollector(train_len)
     
     for epoch_idx in range(N_EPOCHS):
         t1 = time.perf_counter()
@@ -1102,13 +1638,7 @@ def RunFCNNNoProj(
                 running_loss += loss.item()
 
             if epoch_idx == N_EPOCHS - 1:
-                #                labels = encoder_out.max(1)[1].float()
-                if i == 0:
-                    data_encoder = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
-                else:
-
-                    tmp2 = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
-                    data_encoder = torch.cat((data_encoder, tmp2), dim=0)
+                predictions.add(encoder_out, labels)
 
         t2 = time.perf_counter()
         train_time.append(t2 - t1)
@@ -1124,43 +1654,14 @@ def RunFCNNNoProj(
         epoch_loss.append(running_loss / train_len)
 
         
-        # testing our model
-        running_loss = 0
-        net.eval()
-
-        for i, batch in enumerate(test_dl):
-            with torch.no_grad():
-                x = batch[0]
-                labels = batch[1]
-                if torch.cuda.is_available():
-                    x = x.cuda()
-                    labels = labels.cuda()
-                    
-                encoder_out_test = net(x)
-                # Compute the loss
-                #loss_classification = criterion_classification(torch.nn.functional.log_softmax(encoder_out,dim=1), labels)
-                loss = criterion_regression(encoder_out_test.flatten(), labels)
-                running_loss += loss.item()
-               
-        """
-        print(
-            "test accuracy : ",
-            running_accuracy / test_len,
-            "Total test loss:",
-            running_loss / float(test_len),
-            "test loss_recon: ",
-            running_reconstruction / test_len,
-            "test loss_classif: ",
-            running_classification / test_len,
-        )
-        """
-        
-        if running_loss < best_test:
-            best_net_it = epoch_idx
-            best_test = running_loss
-            torch.save(net.state_dict(), str(outputPath) + "best_net")
-    
-        epoch_val_loss.append(running_loss / test_len)
+        # testing our model, every VAL_EVERY epochs and at the last epoch
+        if (epoch_idx + 1) % VAL_EVERY == 0 or epoch_idx == N_EPOCHS - 1:
+            running_loss = validationLoss(net, x_val, labels_val, criterion_regression)
+            if running_loss < best_test:
+                best_net_it = epoch_idx
+                best_test = running_loss
+                best_state = snapshotNet(net, best_state)
+            epoch_val_loss.append(running_loss / test_len)
         
         
         """
@@ -1227,7 +1728,12 @@ def RunFCNNNoProj(
         #        N_EPOCHS, sum(train_time), np.mean(train_time)
         #    )
         #)
-    return data_encoder, epoch_loss, best_test, net
+    data_encoder = predictions.result()
+    # Save the best net once, under the name of this (seed, fold, phase)
+    if netName is None:
+        netName = bestNetName(seed, fold_idx, typeEpoch)
+    torch.save(best_state, str(outputPath) + netName)
+    return data_encoder, epoch_loss, best_test, net, best_state
 
 def RunAutoEncoder(
     net: nn.Module,
@@ -1253,6 +1759,9 @@ def RunAutoEncoder(
     TOL=1e-3,
     AXIS=0,
     typeEpoch=None,
+    TARGET_FEATURES=None,
+    netName=None,
+    VAL_EVERY=1,
 
 ):
     """Full Autoencoder training loop
@@ -1263,16 +1772,20 @@ def RunAutoEncoder(
         The neural network to train and evaluate
     criterion_regression : loss module
         The regression loss component
-    train_dl : DataLoader
-        Training DataLoader
+    train_dl : TensorLoader, MemmapLoader or DataLoader
+        Training loader
     train_len : int
         Number of samples in the training set
-    test_dl : DataLoader
-        Testing/Evaluation DataLoader
+    test_dl : TensorLoader, MemmapLoader or DataLoader
+        Testing/Evaluation loader
     test_len : int
         Number of samples in the testing set
     optimizer : Optimizer
-        PyTorch optimizer of the model's parameters
+        PyTorch optimizer of the model's parameters. With
+        run_model=="MaskGrad", a MaskedAdam masks the gradients once per
+        step from masks computed when the descent starts; any other optimizer
+        gets the gradients masked at every step from the current weights
+        (maskGradients), as before MaskedAdam
     outputPath : str
         Where to save the results of the run (if SAVE_FILE)
     TYPE_PROJ : Projection
@@ -1293,11 +1806,28 @@ def RunAutoEncoder(
         The tolerance for the proj_l1inf algorithm, by default 1e-5
     AXIS : int, optional
         The projection axis, by default 0
+    TARGET_FEATURES : int, optional
+        If set with bilevel_proj_l1Inftyball, the radius of the first layer
+        projection is computed to keep exactly this number of features
+        (see eta_for_target_features) instead of using ETA, by default None
+    netName : str, optional
+        File name of the best net in outputPath, by default
+        bestNetName(seed, fold_idx, typeEpoch)
+    VAL_EVERY : int, optional
+        Validate (and track the best net) every VAL_EVERY epochs and at the
+        last epoch, by default 1
 
     Returns
     -------
-    data_encoder, epoch_loss, best_test, net
+    data_encoder, epoch_loss, best_test, net, best_state
+        best_state is the state_dict of the best epoch (see snapshotNet)
     """
+    if TARGET_FEATURES is not None and TYPE_PROJ != bilevel_proj_l1Inftyball:
+        raise ValueError(
+            "TARGET_FEATURES requires TYPE_PROJ bilevel_proj_l1Inftyball, got {}".format(
+                getattr(TYPE_PROJ, "__name__", TYPE_PROJ))
+        )
+    mask_each_step = run_model == "MaskGrad" and not isinstance(optimizer, MaskedAdam)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     epoch_loss,  train_time = (
         [],
@@ -1307,6 +1837,9 @@ def RunAutoEncoder(
         epoch_val_loss
     ) = ([])
     best_test = np.inf 
+    best_state = None
+    x_val, labels_val = validationData(test_dl, device)
+    predictions = PredictionCollector(train_len)
     for epoch_idx in range(N_EPOCHS):
         t1 = time.perf_counter()
         running_loss = 0
@@ -1326,34 +1859,15 @@ def RunAutoEncoder(
             optimizer.zero_grad()
             loss.backward()
 
-            # Set the gradient as 0
-            if run_model == "MaskGrad":
-                net_parameters = list(net.parameters())
-                for index, param in enumerate(net_parameters):
-                    is_middle = index == (len(net_parameters) / 2) - 1
-                    if (
-                        not DO_PROJ_MIDDLE
-                    ) and is_middle:  # Do no gradient masking at middle layer
-                        pass
-                   
-                    elif index % 2 == 0:
-                        param.grad = torch.where(
-                            param.data.abs() < 1e-4,
-                            torch.zeros_like(param.grad),
-                            param.grad,
-                        )
+            # MaskGrad: the gradients are masked by the step of MaskedAdam
+            if mask_each_step:
+                maskGradients(net, DO_PROJ_MIDDLE)
             optimizer.step()
             with torch.no_grad():
                 running_loss += loss.item()
 
             if epoch_idx == N_EPOCHS - 1:
-                #                labels = encoder_out.max(1)[1].float()
-                if i == 0:
-                    data_encoder = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
-                else:
-
-                    tmp2 = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
-                    data_encoder = torch.cat((data_encoder, tmp2), dim=0)
+                predictions.add(encoder_out, labels)
 
         t2 = time.perf_counter()
         train_time.append(t2 - t1)
@@ -1370,68 +1884,17 @@ def RunAutoEncoder(
 
         # Do projection at last epoch (GRADIENT_MASK)
         if run_model == "ProjectionLastEpoch" and epoch_idx == (N_EPOCHS - 1):
-            net_parameters = list(net.parameters())
-            for index, param in enumerate(net_parameters):
-                is_middle = index == len(net_parameters) / 2 - 1
-                # if (
-                #     DO_PROJ_MIDDLE == False and is_middle
-                # ):  # Do no projection at middle layer
-                #     print(
-                #         f"Did not project layer {index} ({param.shape}) because: middle"
-                #     )
-                # elif (
-                #     is_decoder_layer and not DO_PROJ_DECODER
-                # ):  # Do no projection on the decoder layers
-                #     print(
-                #           f"Did not project layer {index} ({param.shape}) because: decoder"
-                #       )
-                if( DO_PROJ_MIDDLE == True or not is_middle ) :
-                        param.data = Projection(
-                            param.data, TYPE_PROJ, ETA,  AXIS=AXIS, ETA_STAR=ETA_STAR, device=device, TOL=TOL,).to(device)
-
-# =============================================================================
-#                     param.data = Projection(
-#                         param.data, TYPE_PROJ, ETA, AXIS=AXIS, ETA_STAR=ETA_STAR, device=device, TOL=TOL,).to(device)
-# =============================================================================
-
-        # testing our model
-        running_loss = 0
-        net.eval()
-
-        for i, batch in enumerate(test_dl):
-            with torch.no_grad():
-                x = batch[0]
-                labels = batch[1]
-                if torch.cuda.is_available():
-                    x = x.cuda()
-                    labels = labels.cuda()
-                    
-                encoder_out_test = net(x)
-                # Compute the loss
-                #loss_classification = criterion_classification(torch.nn.functional.log_softmax(encoder_out,dim=1), labels)
-                 
-                loss = criterion_regression(encoder_out_test.flatten(), labels)
-                running_loss += loss.item()
-               
-        """
-        print(
-            "test accuracy : ",
-            running_accuracy / test_len,
-            "Total test loss:",
-            running_loss / float(test_len),
-            "test loss_recon: ",
-            running_reconstruction / test_len,
-            "test loss_classif: ",
-            running_classification / test_len,
-        )
-        """
-        
-        if running_loss < best_test:
-            best_net_it = epoch_idx
-            best_test = running_loss
-            torch.save(net.state_dict(), str(outputPath) + "best_net")
-    
-        epoch_val_loss.append(running_loss / test_len)
+            projectNet(net, TYPE_PROJ, ETA, DO_PROJ_MIDDLE, ETA_STAR=ETA_STAR, TOL=TOL,
+                       AXIS=AXIS, TARGET_FEATURES=TARGET_FEATURES, device=device)
+
+        # testing our model, every VAL_EVERY epochs and at the last epoch
+        if (epoch_idx + 1) % VAL_EVERY == 0 or epoch_idx == N_EPOCHS - 1:
+            running_loss = validationLoss(net, x_val, labels_val, criterion_regression)
+            if running_loss < best_test:
+                best_net_it = epoch_idx
+                best_test = running_loss
+                best_state = snapshotNet(net, best_state)
+            epoch_val_loss.append(running_loss / test_len)
         
         
         """
@@ -1496,13 +1959,19 @@ def RunAutoEncoder(
         #        N_EPOCHS, sum(train_time), np.mean(train_time)
         #    )
         #)
-    return data_encoder, epoch_loss, best_test, net
+    data_encoder = predictions.result()
+    # Save the best net once, under the name of this (seed, fold, phase)
+    if netName is None:
+        netName = bestNetName(seed, fold_idx, typeEpoch)
+    torch.save(best_state, str(outputPath) + netName)
+    return data_encoder, epoch_loss, best_test, net, best_state
 
 
 def training(seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm, feature_names,
              GRADIENT_MASK, net_name, LR, criterion_regression, train_dl, train_len,
              gaussianKDE, test_dl, test_len, outputPath, TYPE_PROJ,SEEDS,fold_idx,
-             nfolds, N_EPOCHS, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL):
+             nfolds, N_EPOCHS, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL,
+             TARGET_FEATURES=None, VAL_EVERY=1, COMPACT=False, ETA_STAR=100):
     
     np.random.seed(seed)
     torch.manual_seed(seed)
@@ -1525,7 +1994,7 @@ def training(seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm, feature
     lr_scheduler = torch.optim.lr_scheduler.StepLR(
         optimizer, step_size=150, gamma=0.1
     )
-    data_encoder, epoch_loss, best_test, trained_net = RunAutoEncoder(
+    data_encoder, epoch_loss, best_test, trained_net, best_state = RunAutoEncoder(
         net,
         criterion_regression,
         train_dl,
@@ -1545,102 +2014,1181 @@ def training(seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm, feature
         run_model,
         DO_PROJ_MIDDLE,
         ETA,
+        ETA_STAR=ETA_STAR,
         AXIS=AXIS,
         TOL=TOL,
-        typeEpoch="Adam"
+        typeEpoch="Adam",
+        TARGET_FEATURES=TARGET_FEATURES,
+        VAL_EVERY=VAL_EVERY,
     )
 
     weights_interim_enc , _ = fnp.weights_and_sparsity(trained_net, TOL)
 
     # Do masked gradient
     if GRADIENT_MASK:
+        data_encoder, net, best_state = maskGradDescent(
+            trained_net, seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm,
+            net_name, LR, criterion_regression, train_dl, train_len, gaussianKDE,
+            test_dl, test_len, outputPath, TYPE_PROJ, SEEDS, fold_idx, nfolds,
+            N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL, VAL_EVERY=VAL_EVERY,
+            COMPACT=COMPACT)
+       
+    return data_encoder, net, best_state
+
+
+def maskGradDescent(trained_net, seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden,
+                    norm, net_name, LR, criterion_regression, train_dl, train_len,
+                    gaussianKDE, test_dl, test_len, outputPath, TYPE_PROJ, SEEDS,
+                    fold_idx, nfolds, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL,
+                    netName=None, VAL_EVERY=1, COMPACT=False):
+    """Second descent of training(): zero the weights of the projected net below
+    TOL and retrain it with masked gradients. trained_net is modified in place.
+    With COMPACT the input features whose column is zero are removed from
+    the first layer before the descent (compactNet) and the returned net is
+    the compact one.
+    Return data_encoder, net and the state of the best epoch.
+    """
+    # Get initial network and set zeros
+    # Recall the SEED to get the initial parameters
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
 
-        prev_data = [param.data for param in list(trained_net.parameters())]
+    # run AutoEncoder
+    net = buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm )
 
-        # Get initial network and set zeros
-        # Recall the SEED to get the initial parameters
-        np.random.seed(seed)
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
+    maskSmallWeights(trained_net, DO_PROJ_MIDDLE, TOL)
+    if COMPACT:
+        trained_net = compactNet(trained_net)
+        print("Compact first layer: {} of {} features".format(
+            trained_net.encoder[0].in_features, feature_len))
 
-        # run AutoEncoder
-        net = buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm )
-        
-        optimizer = torch.optim.Adam(trained_net.parameters(), lr=LR)
-        lr_scheduler = torch.optim.lr_scheduler.StepLR(
-            optimizer, 150, gamma=0.1
-        )  # unused in the paper
-
-        net_parameters = list(trained_net.parameters())
-        for index, param in enumerate(net_parameters):
-            is_middle = index == (len(net_parameters) / 2) - 1
-            if (
-                not DO_PROJ_MIDDLE
-            ) and is_middle:  # Do no gradient masking at middle layer
-                pass
-            elif index % 2 == 0:
-                param.data = torch.where(
-                    prev_data[index].abs() < TOL,
-                    torch.zeros_like(param.data),
-                    param.data,
-                )
+    # the weights set to zero are frozen for the whole descent
+    masks = gradMasks(trained_net, DO_PROJ_MIDDLE)
+    optimizer = MaskedAdam(trained_net.parameters(), masks, lr=LR)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(
+        optimizer, 150, gamma=0.1
+    )  # unused in the paper
 
-        run_model = "MaskGrad"
-        (
-            data_encoder,
-            epoch_loss,
-            best_test,
-            net,
-        ) = RunAutoEncoder(
-            trained_net,
-            criterion_regression,
-            train_dl,
-            train_len,
-            gaussianKDE,
-            test_dl,
-            test_len,
-            optimizer,
-            outputPath,
-            TYPE_PROJ,
-            seed,
-            SEEDS,
-            fold_idx,
-            nfolds,
-            lr_scheduler,
-            N_EPOCHS_MASKGRAD,
-            run_model,
-            DO_PROJ_MIDDLE,
-            ETA,
-            AXIS=AXIS,typeEpoch=run_model
-        )
-            
-       
-    return data_encoder, net
+    run_model = "MaskGrad"
+    (
+        data_encoder,
+        epoch_loss,
+        best_test,
+        net,
+        best_state,
+    ) = RunAutoEncoder(
+        trained_net,
+        criterion_regression,
+        train_dl,
+        train_len,
+        gaussianKDE,
+        test_dl,
+        test_len,
+        optimizer,
+        outputPath,
+        TYPE_PROJ,
+        seed,
+        SEEDS,
+        fold_idx,
+        nfolds,
+        lr_scheduler,
+        N_EPOCHS_MASKGRAD,
+        run_model,
+        DO_PROJ_MIDDLE,
+        ETA,
+        AXIS=AXIS,typeEpoch=run_model,
+        netName=netName,
+        VAL_EVERY=VAL_EVERY,
+    )
+    return data_encoder, net, best_state
+
+
+def maskSmallWeights(net, DO_PROJ_MIDDLE, TOL):
+    """Set to zero the weights of net below TOL, the layers masked by the
+    gradient masking of RunAutoEncoder ("MaskGrad")"""
+    net_parameters = list(net.parameters())
+    for index, param in enumerate(net_parameters):
+        is_middle = index == (len(net_parameters) / 2) - 1
+        if (
+            not DO_PROJ_MIDDLE
+        ) and is_middle:  # Do no gradient masking at middle layer
+            pass
+        elif index % 2 == 0:
+            param.data = torch.where(
+                param.data.abs() < TOL,
+                torch.zeros_like(param.data),
+                param.data,
+            )
 
 
-def buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm ):
-    if net_name == "LeNet":
-        net = LeNet_300_100(n_inputs=feature_len, n_outputs=1, activation=TYPE_ACTIVATION).to(
-            DEVICE
-        )  # LeNet
-    if net_name == "netBio":
-        net = netBio(feature_len, 1, n_hidden, activation=TYPE_ACTIVATION, norm = norm).to(DEVICE)  # netBio
+def gradMasks(net, DO_PROJ_MIDDLE, tol=1e-4):
+    """Masks of the weights trained by the masked gradient descent (MaskGrad),
+    computed once when it starts: True where the weight is not below tol, for
+    the layers of maskSmallWeights. Every mask is also registered on the
+    module of its weight as a boolean buffer <name>_mask (not in the
+    state_dict).
+    Return:
+        masks: list of (param, mask)
+    """
+    net_parameters = list(net.named_parameters())
+    masks = []
+    for index, (name, param) in enumerate(net_parameters):
+        is_middle = index == (len(net_parameters) / 2) - 1
+        if (
+            not DO_PROJ_MIDDLE
+        ) and is_middle:  # Do no gradient masking at middle layer
+            pass
+        elif index % 2 == 0:
+            mask = param.detach().abs() >= tol
+            module_name, _, param_name = name.rpartition(".")
+            net.get_submodule(module_name).register_buffer(
+                param_name + "_mask", mask, persistent=False
+            )
+            masks.append((param, mask))
+    return masks
+
+
+def maskGradients(net, DO_PROJ_MIDDLE, tol=1e-4):
+    """Set to zero the gradients of the weights below tol, for the layers of
+    gradMasks (the masked gradient descent with an optimizer other than
+    MaskedAdam, the masks being recomputed at every step)"""
+    net_parameters = list(net.parameters())
+    for index, param in enumerate(net_parameters):
+        is_middle = index == (len(net_parameters) / 2) - 1
+        if (
+            not DO_PROJ_MIDDLE
+        ) and is_middle:  # Do no gradient masking at middle layer
+            pass
+        elif index % 2 == 0:
+            param.grad = torch.where(
+                param.data.abs() < tol,
+                torch.zeros_like(param.grad),
+                param.grad,
+            )
 
-    if net_name == "FAIR":
-        net = FairAutoEncoder(feature_len, 1, n_hidden, activation=TYPE_ACTIVATION, norm = norm).to(DEVICE)  # netBio
 
-    if net_name == "dnn":
-        net = DNN(feature_len, n_hidden, 0.1, ratio = False).to(DEVICE)  # netBio
-    return net
+class MaskedAdam(torch.optim.Adam):
+    """Adam on the masked parameters of gradMasks: the gradients are multiplied
+    in place by their mask before each step. The masks being fixed for the
+    whole descent, the moments of the frozen entries stay zero and these
+    entries are never updated.
 
+    Attributes:
+        masks: list of (param, mask) - see gradMasks
+    """
 
-def selectf(x, feature_name):
-    x = x.cpu()
-    _, d = x.shape
-    mat = []
-    lenmax = min(len(feature_name), d) 
-    for i in range(lenmax):
-        mat.append([feature_name[i] + "", np.linalg.norm(x[:, i])])
+    def __init__(self, params, masks, **kwargs):
+        super().__init__(params, **kwargs)
+        self.masks = masks
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for param, mask in self.masks:
+            if param.grad is not None:
+                param.grad.mul_(mask)
+        super().step()
+        return loss
+
+
+class SelectLinear(nn.Linear):
+    """First layer of a net compacted by compactNet: a Linear layer on the
+    input features of index only. It is fed with all the features, so the
+    compact net is used (and interpreted by topGenes) as the full one.
+
+    Attributes:
+        index: LongTensor (buffer) - input features of the columns of weight
+        n_features: int - number of features of the input
+    """
+
+    def __init__(self, index, n_features, out_features, bias=True, device=None):
+        super().__init__(len(index), out_features, bias=bias, device=device)
+        self.register_buffer("index", torch.as_tensor(index, dtype=torch.long, device=device))
+        self.n_features = n_features
+
+    def forward(self, x):
+        return super().forward(x.index_select(-1, self.index))
+
+    def fullWeight(self):
+        """Weight over all the input features, zero for the removed ones"""
+        weight = self.weight.detach()
+        full = weight.new_zeros(self.out_features, self.n_features)
+        return full.index_copy_(1, self.index, weight)
+
+
+def compactNet(net):
+    """Copy of net whose first layer (encoder.0) only keeps the input features
+    with a nonzero column, as a SelectLinear: the same function of the input
+    with a smaller first product"""
+    layer = net.encoder[0]
+    weight = layer.weight.detach()
+    keep = torch.nonzero(weight.abs().sum(dim=0) > 0).flatten()
+    if isinstance(layer, SelectLinear):
+        index, n_features = layer.index[keep], layer.n_features
+    else:
+        index, n_features = keep, layer.in_features
+    compact = copy.deepcopy(net)
+    # the initialization of the new layer must not move the seeded generator
+    # (minibatch shuffles of the descent), its weights are overwritten anyway
+    with torch.random.fork_rng(devices=[]):
+        compact.encoder[0] = SelectLinear(
+            index.cpu(), n_features, layer.out_features, bias=layer.bias is not None,
+        ).to(weight.device)
+    with torch.no_grad():
+        compact.encoder[0].weight.copy_(weight[:, keep])
+        if layer.bias is not None:
+            compact.encoder[0].bias.copy_(layer.bias)
+    return compact
+
+
+def inputWeight(net):
+    """Weight of the first layer of net over all the input features (the
+    encoder.0.weight of a net that is not compact)"""
+    layer = net.encoder[0]
+    if isinstance(layer, SelectLinear):
+        return layer.fullWeight()
+    return layer.weight.detach()
+
+
+class PrunedLayerNorm(nn.Module):
+    """LayerNorm of a hidden layer whose dead neurons were removed by
+    pruneNeurons. The constant outputs of the removed neurons still count in
+    the mean and variance, and the normalization returns the kept neurons
+    followed by two units, 1/sigma and mu/sigma, through which the next
+    Linear layer gets the (input dependent) contribution of the removed ones.
+
+    Attributes:
+        const: Tensor (buffer) - outputs of the removed neurons
+        n_features: int - size of the original layer
+        weight, bias: Parameter - affine parameters of the kept neurons
+    """
+
+    def __init__(self, layer_norm, keep, const):
+        super().__init__()
+        self.register_buffer("const", const.detach().clone())
+        self.n_features = layer_norm.normalized_shape[0]
+        self.eps = layer_norm.eps
+        self.const_sum = self.const.sum().item()
+        self.const_mean = self.const.mean().item() if len(self.const) else 0.0
+        self.const_ss = (self.const - self.const_mean).square().sum().item()
+        self.weight = self.bias = None
+        if layer_norm.weight is not None:
+            self.weight = nn.Parameter(layer_norm.weight.detach()[keep].clone())
+        if layer_norm.bias is not None:
+            self.bias = nn.Parameter(layer_norm.bias.detach()[keep].clone())
+
+    def forward(self, x):
+        # mean and variance over the kept and the removed neurons, the sums
+        # over the removed ones being precomputed
+        mu = (x.sum(-1, keepdim=True) + self.const_sum) / self.n_features
+        centered = x - mu
+        shift = mu - self.const_mean
+        var = (
+            torch.linalg.vecdot(centered, centered).unsqueeze(-1) + self.const_ss
+            + len(self.const) * shift * shift
+        ) / self.n_features
+        inv = torch.rsqrt(var + self.eps)
+        out = centered * inv
+        if self.weight is not None:
+            out = out * self.weight
+        if self.bias is not None:
+            out = out + self.bias
+        return torch.cat((out, inv, mu * inv), dim=-1)
+
+
+ELEMENTWISE = (nn.Tanh, nn.ReLU, nn.GELU, nn.ELU, nn.SiLU)
+
+
+def pruneNeurons(net, tol=1.0e-3):
+    """Copy of net without the dead hidden neurons of its encoder: the rows of
+    the hidden Linear layers below tol (see sparsity_line), as left by the
+    projections with AXIS=0. A dead neuron outputs a constant, the
+    activation of its bias, which is folded into the bias of the next Linear
+    layer before its column is removed (with a LayerNorm in between see
+    PrunedLayerNorm). The pruned net computes the same function.
+
+    Attributes:
+        net: nn.Module - net with an encoder of Linear layers, activations
+            and LayerNorm (FairAutoEncoder, LeNet_300_100, netBio)
+        tol: Scalar, optional - the threshold to select zeros
+    Returns:
+        pruned: nn.Module - the smaller net
+    """
+    pruned = copy.deepcopy(net)
+    modules = list(pruned.encoder)
+    linears = [i for i, module in enumerate(modules) if isinstance(module, nn.Linear)]
+    pending = None  # removed neurons of the previous Linear layer
+    for k, i in enumerate(linears):
+        layer = modules[i]
+        weight = layer.weight.detach()
+        bias = None if layer.bias is None else layer.bias.detach()
+        alive = torch.where(weight.abs() < tol, 0.0, weight).abs().sum(1) > 0
+        if k == len(linears) - 1 or alive.all():
+            alive = torch.ones_like(alive)
+        if pending is not None:
+            weight, bias = foldNeurons(weight, bias, *pending)
+        pending = None
+        if not alive.all():
+            keep, dead = torch.nonzero(alive).flatten(), torch.nonzero(~alive).flatten()
+            const = weight.new_zeros(len(dead)) if bias is None else bias[dead]
+            weight = weight[keep]
+            bias = None if bias is None else bias[keep]
+            norm = None
+            for j in range(i + 1, linears[k + 1]):
+                module = modules[j]
+                if norm is None and isinstance(module, ELEMENTWISE):
+                    const = module(const)
+                elif norm is None and isinstance(module, nn.LayerNorm):
+                    modules[j] = PrunedLayerNorm(module, keep, const)
+                    norm = (
+                        torch.ones_like(const) if module.weight is None
+                        else module.weight.detach()[dead],
+                        torch.zeros_like(const) if module.bias is None
+                        else module.bias.detach()[dead],
+                    )
+                else:
+                    raise TypeError(
+                        "pruneNeurons: {} in a hidden layer, only the activations {} "
+                        "followed by at most one LayerNorm are supported".format(
+                            type(module).__name__,
+                            ", ".join(t.__name__ for t in ELEMENTWISE))
+                    )
+            pending = (keep, dead, const, norm)
+        if weight.shape != layer.weight.shape or bias is not layer.bias:
+            modules[i] = rebuildLinear(layer, weight, bias)
+    pruned.encoder = nn.Sequential(*modules)
+    return pruned
+
+
+def foldNeurons(weight, bias, keep, dead, const, norm):
+    """Weight and bias of the Linear layer following the neurons removed by
+    pruneNeurons: the columns of keep, the contribution of the constant
+    outputs const of the dead ones being folded into the bias. With a
+    LayerNorm in between, norm is its (weight, bias) for the dead neurons and
+    their normalized outputs go through the two units of PrunedLayerNorm."""
+    removed = weight[:, dead]
+    weight = weight[:, keep]
+    if norm is None:
+        shift = removed @ const
+    else:
+        gamma, beta = norm
+        # gamma * (const - mu) / sigma + beta
+        weight = torch.cat((
+            weight,
+            (removed @ (gamma * const))[:, None],
+            -(removed @ gamma)[:, None],
+        ), dim=1)
+        shift = removed @ beta
+    if bias is None:
+        return weight, shift if shift.abs().sum() > 0 else None
+    return weight, bias + shift
+
+
+def rebuildLinear(layer, weight, bias):
+    """Linear layer (or SelectLinear) like layer with the given weight and bias"""
+    # the initialization must not move the seeded generator (see compactNet)
+    with torch.random.fork_rng(devices=[]):
+        if isinstance(layer, SelectLinear):
+            new = SelectLinear(layer.index.cpu(), layer.n_features, weight.shape[0],
+                               bias=bias is not None)
+        else:
+            new = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    new = new.to(weight.device)
+    with torch.no_grad():
+        new.weight.copy_(weight)
+        if bias is not None:
+            new.bias.copy_(bias)
+    return new
+
+
+class SparseLinear(nn.Module):
+    """Linear layer (or SelectLinear) for the inference, its weight being
+    stored in CSR format: the matrix product only visits the nonzero
+    weights left by the projections with an unstructured sparsity
+    (proj_l1ball, proj_l11ball, ...). Only the forward is implemented.
+
+    Attributes:
+        crow_indices, col_indices, values: Tensor (buffers) - CSR weight
+        bias: Tensor (buffer) - or None
+        index: LongTensor (buffer) - input features of a SelectLinear, or None
+        in_features, out_features: int - shape of the weight
+    """
+
+    def __init__(self, layer):
+        super().__init__()
+        weight = layer.weight.detach().to_sparse_csr()
+        self.out_features, self.in_features = weight.shape
+        self.register_buffer("crow_indices", weight.crow_indices())
+        self.register_buffer("col_indices", weight.col_indices())
+        self.register_buffer("values", weight.values())
+        self.register_buffer(
+            "bias", None if layer.bias is None else layer.bias.detach().clone()
+        )
+        self.register_buffer("index", getattr(layer, "index", None))
+
+    def forward(self, x):
+        if self.index is not None:
+            x = x.index_select(-1, self.index)
+        weight = torch.sparse_csr_tensor(
+            self.crow_indices, self.col_indices, self.values,
+            (self.out_features, self.in_features), check_invariants=False,
+        )
+        shape = x.shape
+        x = x.reshape(-1, shape[-1]).T
+        if self.bias is None:
+            out = torch.mm(weight, x)
+        else:
+            out = torch.addmm(self.bias[:, None], weight, x)
+        return out.T.reshape(*shape[:-1], self.out_features)
+
+
+def sparseNet(net, threshold=0.9, batch_size=1000, repeat=5, verbose=False):
+    """Copy of net for the inference where the Linear layers with a sparsity
+    (share of zero weights) of at least threshold are replaced by a
+    SparseLinear, when it is faster on this machine: both are timed on a
+    batch of batch_size random samples (best of repeat runs).
+
+    Attributes:
+        net: nn.Module - the net
+        threshold: Scalar - minimal sparsity of the converted layers
+        batch_size: int - batch of the timings, as the batches of the inference
+        verbose: bool - print the sparsity and the timings of every candidate layer
+    Returns:
+        sparse: nn.Module - the net with SparseLinear layers
+    """
+
+    def best(layer, x):
+        times = []
+        with torch.no_grad():
+            layer(x)  # warm up
+            for _ in range(repeat):
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                t1 = time.perf_counter()
+                layer(x)
+                if x.is_cuda:
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - t1)
+        return min(times)
+
+    sparse = copy.deepcopy(net)
+    layers = [(name, module) for name, module in sparse.named_modules()
+              if isinstance(module, nn.Linear)]
+    for name, layer in layers:
+        weight = layer.weight.detach()
+        zeros = 1.0 - torch.count_nonzero(weight).item() / weight.numel()
+        if zeros < threshold:
+            continue
+        candidate = SparseLinear(layer)
+        n_inputs = layer.n_features if isinstance(layer, SelectLinear) else layer.in_features
+        x = torch.randn(batch_size, n_inputs, device=weight.device)
+        t_dense, t_sparse = best(layer, x), best(candidate, x)
+        if verbose:
+            print("{}: {:.1f}% zeros, dense {:.0f} us, CSR {:.0f} us".format(
+                name, 100 * zeros, 1e6 * t_dense, 1e6 * t_sparse))
+        if t_sparse < t_dense:
+            parent, _, child = name.rpartition(".")
+            setattr(sparse.get_submodule(parent), child, candidate)
+    return sparse
+
+
+def trainingSweep(seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm, feature_names,
+                  net_name, LR, criterion_regression, train_dl, train_len,
+                  gaussianKDE, test_dl, test_len, outputPath, TYPE_PROJ, SEEDS, fold_idx,
+                  nfolds, N_EPOCHS, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETAS, AXIS, TOL,
+                  VAL_EVERY=1, COMPACT=False, ETA_STAR=100, TARGET_FEATURES=None):
+    """training() with GRADIENT_MASK for every radius of ETAS, sharing the first descent.
+    The dense net is trained once for N_EPOCHS and kept in memory before the
+    projection; for each ETA a copy is projected then retrained with masked
+    gradients. Each result is the same as training() with this ETA.
+    The best net of each ETA is saved as
+    outputPath + bestNetName(seed, fold_idx, "MaskGrad_ETA" + str(ETA)).
+
+    Returns:
+        results: list of (data_encoder, net, best_state), one per ETA
+    """
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+
+    net = buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm )
+
+    optimizer = torch.optim.Adam(net.parameters(), lr=LR)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(
+        optimizer, step_size=150, gamma=0.1
+    )
+    # The first descent does not depend on ETA: train it without projection
+    _, _, _, dense_net, _ = RunAutoEncoder(
+        net,
+        criterion_regression,
+        train_dl,
+        train_len,
+        gaussianKDE,
+        test_dl,
+        test_len,
+        optimizer,
+        outputPath,
+        TYPE_PROJ,
+        seed,
+        SEEDS,
+        fold_idx,
+        nfolds,
+        lr_scheduler,
+        N_EPOCHS,
+        "No_proj",
+        DO_PROJ_MIDDLE,
+        AXIS=AXIS,
+        TOL=TOL,
+        typeEpoch="Adam",
+        TARGET_FEATURES=TARGET_FEATURES,
+        VAL_EVERY=VAL_EVERY,
+    )
+    snapshot = copy.deepcopy(dense_net)
+
+    results = []
+    for ETA in ETAS:
+        print(f"----------- ETA = {ETA} ---------------")
+        trained_net = copy.deepcopy(snapshot)
+        projectNet(trained_net, TYPE_PROJ, ETA, DO_PROJ_MIDDLE, ETA_STAR=ETA_STAR, TOL=TOL,
+                   AXIS=AXIS, TARGET_FEATURES=TARGET_FEATURES, device=DEVICE)
+        data_encoder, net, best_state = maskGradDescent(
+            trained_net, seed, feature_len, TYPE_ACTIVATION, DEVICE, n_hidden, norm,
+            net_name, LR, criterion_regression, train_dl, train_len, gaussianKDE,
+            test_dl, test_len, outputPath, TYPE_PROJ, SEEDS, fold_idx, nfolds,
+            N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL,
+            netName=bestNetName(seed, fold_idx, "MaskGrad_ETA" + str(ETA)),
+            VAL_EVERY=VAL_EVERY, COMPACT=COMPACT)
+        results.append((data_encoder, net, best_state))
+
+    return results
+
+
+def validationData(test_dl, device="cpu"):
+    """The validation set of test_dl as two tensors on device (see validationLoss),
+    or the loader itself and None for a MemmapLoader (read batch by batch)"""
+    if isinstance(test_dl, MemmapLoader):
+        return test_dl, None
+    return test_dl.dataset.X.to(device), test_dl.dataset.Y.to(device)
+
+
+def validationLoss(net, x, labels, criterion_regression, chunk_size=4096):
+    """Validation loss of net, batched forward over chunks of chunk_size samples
+    (or over the batches of x if x is a MemmapLoader and labels None).
+    The loss of every sample is computed alone, as with the batch_size=1
+    test loader of CrossVal, summed on the device and synced once.
+    """
+    if labels is None:
+        chunks = ((batch[0], batch[1]) for batch in x)
+    else:
+        chunks = (
+            (x[start : start + chunk_size], labels[start : start + chunk_size])
+            for start in range(0, len(x), chunk_size)
+        )
+    criterion = copy.copy(criterion_regression)
+    criterion.reduction = "none"
+    net.eval()
+    running_loss = torch.zeros((), dtype=torch.float64, device=next(net.parameters()).device)
+    with torch.no_grad():
+        for x_chunk, labels_chunk in chunks:
+            encoder_out = net(x_chunk)
+            loss = criterion(encoder_out.flatten(), labels_chunk)
+            running_loss += loss.double().sum()
+    return running_loss.item()
+
+
+def bestNetName(seed, fold_idx, phase):
+    """File name of the best net of a (seed, fold) training phase"""
+    return "best_net_seed{}_fold{}_{}".format(seed, fold_idx, phase)
+
+
+def snapshotNet(net, snapshot=None):
+    """Copy the state_dict of net into snapshot, allocated at the first call
+    and reused after, and return it"""
+    with torch.no_grad():
+        if snapshot is None:
+            return {key: value.detach().clone() for key, value in net.state_dict().items()}
+        for key, value in net.state_dict().items():
+            snapshot[key].copy_(value)
+    return snapshot
+
+
+class StackedAdam:
+    """Adam (defaults of torch.optim.Adam) on stacked parameters, the first
+    dimension of every parameter indexes the models. Each model has its own
+    step count: a model without batch at a step (active False) is unchanged.
+    masks (one boolean tensor or None per parameter) mask the gradients as
+    MaskedAdam.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, masks=None):
+        self.params = list(params)
+        self.masks = [None] * len(self.params) if masks is None else list(masks)
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.steps = torch.zeros(self.params[0].shape[0], device=self.params[0].device)
+        self.exp_avg = [torch.zeros_like(param) for param in self.params]
+        self.exp_avg_sq = [torch.zeros_like(param) for param in self.params]
+
+    def zero_grad(self):
+        for param in self.params:
+            param.grad = None
+
+    @torch.no_grad()
+    def step(self, active):
+        beta1, beta2 = self.betas
+        inactive = (~active).nonzero().flatten()
+        self.steps += active
+        steps = self.steps.clamp(min=1)
+        step_size = self.lr / (1 - beta1**steps)
+        bias_correction2_sqrt = (1 - beta2**steps).sqrt()
+        for param, exp_avg, exp_avg_sq, mask in zip(
+            self.params, self.exp_avg, self.exp_avg_sq, self.masks
+        ):
+            shape = (-1,) + (1,) * (param.dim() - 1)
+            # the models without batch keep their parameters and moments
+            kept = [t[inactive].clone() for t in (param, exp_avg, exp_avg_sq)]
+            grad = param.grad
+            if mask is not None:
+                grad.mul_(mask)
+            exp_avg.lerp_(grad, 1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt.view(shape)).add_(self.eps)
+            param.addcdiv_(exp_avg * step_size.view(shape), denom, value=-1)
+            if len(inactive):
+                for t, k in zip((param, exp_avg, exp_avg_sq), kept):
+                    t[inactive] = k
+
+
+def stackNets(nets):
+    """Stack the parameters of nets (same architecture) on a new first dimension
+    Return:
+        params: dict - name -> stacked parameter (leaf, requires_grad)
+    """
+    named = [dict(net.named_parameters()) for net in nets]
+    return {
+        name: torch.stack([p[name].detach() for p in named]).requires_grad_()
+        for name in named[0]
+    }
+
+
+def unstackNets(params, nets):
+    """Copy the stacked parameters back into nets"""
+    with torch.no_grad():
+        for m, net in enumerate(nets):
+            for name, param in net.named_parameters():
+                param.copy_(params[name][m])
+    return nets
+
+
+def padStack(rows, device="cpu"):
+    """Stack the (x, labels) of every model, padded with zeros to the largest
+    one (None for a model without batch)
+    Return:
+        x, labels, mask: tensors - [models, rows, features], [models, rows], [models, rows]
+    """
+    n_rows = max(len(r[1]) for r in rows if r is not None)
+    n_features = next(r[0].shape[1] for r in rows if r is not None)
+    x = torch.zeros(len(rows), n_rows, n_features)
+    labels = torch.zeros(len(rows), n_rows)
+    mask = torch.zeros(len(rows), n_rows, dtype=torch.bool)
+    for m, r in enumerate(rows):
+        if r is not None:
+            x[m, : len(r[1])] = r[0]
+            labels[m, : len(r[1])] = r[1]
+            mask[m, : len(r[1])] = True
+    return x.to(device), labels.to(device), mask.to(device)
+
+
+def epochBatches(train_dl, rng_state):
+    """Minibatches of one epoch of train_dl drawn with the torch RNG state of
+    the model, so the shuffles are the ones of training().
+    The global RNG state is left unchanged.
+    Return:
+        batches, rng_state
+    """
+    state = torch.get_rng_state()
+    torch.set_rng_state(rng_state)
+    batches = [(batch[0], batch[1]) for batch in train_dl]
+    rng_state = torch.get_rng_state()
+    torch.set_rng_state(state)
+    return batches, rng_state
+
+
+def RunStackedAutoEncoder(
+    nets,
+    criterion_regression,
+    loaders,
+    rng_states,
+    outputPath,
+    TYPE_PROJ,
+    jobs,
+    SEEDS,
+    nfolds,
+    LR,
+    N_EPOCHS=30,
+    run_model="No_Proj",
+    DO_PROJ_MIDDLE=False,
+    ETA=100,
+    ETA_STAR=100,
+    TOL=1e-3,
+    AXIS=0,
+    typeEpoch=None,
+    TARGET_FEATURES=None,
+    device="cpu",
+    VAL_EVERY=1,
+):
+    """RunAutoEncoder for several nets trained together: the parameters of the
+    nets are stacked and every minibatch step is one batched (vmap) forward and
+    backward of all the nets, with one Adam (StackedAdam) per net. Each net
+    sees only the minibatches of its own train_dl, keeps its own best epoch
+    and is projected on its own.
+
+    Parameters
+    ----------
+    nets : list of nn.Module
+        The networks to train, same architecture
+    loaders : list of (TensorLoader, TensorLoader)
+        (train_dl, test_dl) of every net
+    rng_states : list of ByteTensor
+        Torch RNG state of every net for the shuffles (see epochBatches),
+        updated in place
+    outputPath : str
+        Where to save the best nets, as bestNetName(seed, fold_idx, typeEpoch)
+    jobs : list of (int, int)
+        (seed, fold_idx) of every net, for the plots
+    LR : float
+        Learning rate of the Adam optimizers
+    The other parameters are those of RunAutoEncoder.
+
+    Returns
+    -------
+    data_encoders, epoch_losses, best_tests, nets, best_states : lists, one item per net
+    """
+    if TARGET_FEATURES is not None and TYPE_PROJ != bilevel_proj_l1Inftyball:
+        raise ValueError(
+            "TARGET_FEATURES requires TYPE_PROJ bilevel_proj_l1Inftyball, got {}".format(
+                getattr(TYPE_PROJ, "__name__", TYPE_PROJ))
+        )
+    n_models = len(nets)
+    params = stackNets(nets)
+    n_params = len(params)
+    masked = [
+        index % 2 == 0 and (DO_PROJ_MIDDLE or index != n_params / 2 - 1)
+        for index in range(n_params)
+    ]
+    masks = None
+    if run_model == "MaskGrad":  # computed once, as gradMasks
+        masks = [
+            param.detach().abs() >= 1e-4 if is_masked else None
+            for param, is_masked in zip(params.values(), masked)
+        ]
+    optimizer = StackedAdam(params.values(), lr=LR, masks=masks)
+    base = copy.deepcopy(nets[0]).to("meta")
+    stacked_net = torch.func.vmap(
+        lambda p, x: torch.func.functional_call(base, p, (x,)), randomness="different"
+    )
+    criterion = copy.copy(criterion_regression)
+    criterion.reduction = "none"
+    x_val, labels_val, mask_val = padStack(
+        [(test_dl.dataset.X, test_dl.dataset.Y) for _, test_dl in loaders], device
+    )
+    train_lens = np.array([len(train_dl.dataset) for train_dl, _ in loaders])
+
+    best_params = {name: param.detach().clone() for name, param in params.items()}
+    epoch_losses = [[] for _ in range(n_models)]
+    best_tests = [np.inf] * n_models
+    best_net_its = [None] * n_models
+    predictions = [PredictionCollector(n) for n in train_lens]
+    for epoch_idx in range(N_EPOCHS):
+        batches = []
+        for m, (train_dl, _) in enumerate(loaders):
+            batches_m, rng_states[m] = epochBatches(train_dl, rng_states[m])
+            batches.append(batches_m)
+        running_loss = np.zeros(n_models)
+        base.train()
+        for i in range(max(len(b) for b in batches)):
+            x, labels, mask = padStack(
+                [b[i] if i < len(b) else None for b in batches], device
+            )
+            encoder_out = stacked_net(params, x)
+            loss = (criterion(encoder_out.squeeze(-1), labels) * mask).sum(dim=1)
+            if criterion_regression.reduction == "mean":
+                loss = loss / mask.sum(dim=1).clamp(min=1)
+            optimizer.zero_grad()
+            loss.sum().backward()
+
+            # MaskGrad: the gradients are masked by the step of StackedAdam
+            optimizer.step(mask.any(dim=1))
+            running_loss += loss.detach().cpu().numpy()
+
+            if epoch_idx == N_EPOCHS - 1:
+                for m in range(n_models):
+                    predictions[m].add(encoder_out[m][mask[m]], labels[m][mask[m]])
+
+        for m in range(n_models):
+            epoch_losses[m].append(running_loss[m] / train_lens[m])
+
+        # Do projection at last epoch (GRADIENT_MASK)
+        if run_model == "ProjectionLastEpoch" and epoch_idx == (N_EPOCHS - 1):
+            unstackNets(params, nets)
+            for net in nets:
+                projectNet(net, TYPE_PROJ, ETA, DO_PROJ_MIDDLE, ETA_STAR=ETA_STAR, TOL=TOL,
+                           AXIS=AXIS, TARGET_FEATURES=TARGET_FEATURES, device=device)
+            with torch.no_grad():
+                for name, param in stackNets(nets).items():
+                    params[name].copy_(param)
+
+        # testing our models, every VAL_EVERY epochs and at the last epoch
+        if (epoch_idx + 1) % VAL_EVERY != 0 and epoch_idx != N_EPOCHS - 1:
+            continue
+        base.eval()
+        with torch.no_grad():
+            encoder_out_test = stacked_net(params, x_val).squeeze(-1)
+            val_loss = (criterion(encoder_out_test, labels_val) * mask_val).double().sum(dim=1)
+        val_loss = val_loss.tolist()
+        for m in range(n_models):
+            if val_loss[m] < best_tests[m]:
+                best_net_its[m] = epoch_idx
+                best_tests[m] = val_loss[m]
+                with torch.no_grad():
+                    for name, param in params.items():
+                        best_params[name][m].copy_(param[m])
+
+    unstackNets(params, nets)
+    best_states = [
+        {name: param[m] for name, param in best_params.items()} for m in range(n_models)
+    ]
+    for m, (seed, fold_idx) in enumerate(jobs):
+        # Save the best net once, under the name of this (seed, fold, phase)
+        torch.save(
+            {name: param.clone() for name, param in best_states[m].items()},
+            str(outputPath) + bestNetName(seed, fold_idx, typeEpoch),
+        )
+        title = f"MSE vs Epoch ({'Proj' if run_model == 'MaskGrad' else 'Initial'}, Training, Seed: {seed} in {SEEDS}, Fold {fold_idx+1}in{nfolds})"
+        y_data = epoch_losses[m]
+        plotGraph(y_data, range(0, len(y_data)), "MSE", "Epoch", title)
+        print(f"Best net epoch for {typeEpoch} (seed {seed}, fold {fold_idx}) = ", best_net_its[m])
+
+    data_encoders = [collector.result() for collector in predictions]
+    return data_encoders, epoch_losses, best_tests, nets, best_states
+
+
+def trainingStacked(jobs, loaders, outputPath, feature_len, TYPE_ACTIVATION, DEVICE,
+                    n_hidden, norm, GRADIENT_MASK, net_name, LR, criterion_regression,
+                    TYPE_PROJ, SEEDS, nfolds, N_EPOCHS, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE,
+                    ETA, AXIS, TOL, TARGET_FEATURES=None, VAL_EVERY=1, ETA_STAR=100):
+    """training() of several (seed, fold) jobs as one stacked model (see
+    RunStackedAutoEncoder). Every net gets the initial weights and the
+    minibatch shuffles of training(), only the rounding of the batched
+    matmuls differs. The nets are not compacted (COMPACT of training()): the
+    number of selected features differs from one job to the other.
+
+    Args:
+        jobs: list of (seed, fold_idx)
+        loaders: list of (train_dl, test_dl), one per job
+        outputPath: str - where to save the best nets (see bestNetName)
+    Returns:
+        results: list of (data_encoder, net, best_state), one per job
+    """
+    nets, rng_states = [], []
+    for seed, _ in jobs:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed(seed)
+        nets.append(buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm))
+        rng_states.append(torch.get_rng_state())
+
+    if not GRADIENT_MASK:
+        TYPE_PROJ = "No_proj"
+    run_model = "ProjectionLastEpoch" if GRADIENT_MASK else "No_proj"
+    data_encoders, _, _, nets, best_states = RunStackedAutoEncoder(
+        nets, criterion_regression, loaders, list(rng_states), outputPath, TYPE_PROJ,
+        jobs, SEEDS, nfolds, LR, N_EPOCHS, run_model, DO_PROJ_MIDDLE, ETA,
+        ETA_STAR=ETA_STAR, TOL=TOL, AXIS=AXIS, typeEpoch="Adam", TARGET_FEATURES=TARGET_FEATURES,
+        device=DEVICE, VAL_EVERY=VAL_EVERY,
+    )
+
+    # Do masked gradient, maskGradDescent reseeds: same shuffles as the first descent
+    if GRADIENT_MASK:
+        for net in nets:
+            maskSmallWeights(net, DO_PROJ_MIDDLE, TOL)
+        data_encoders, _, _, nets, best_states = RunStackedAutoEncoder(
+            nets, criterion_regression, loaders, list(rng_states), outputPath,
+            TYPE_PROJ, jobs, SEEDS, nfolds, LR, N_EPOCHS_MASKGRAD, "MaskGrad",
+            DO_PROJ_MIDDLE, ETA, AXIS=AXIS, typeEpoch="MaskGrad", device=DEVICE,
+            VAL_EVERY=VAL_EVERY,
+        )
+    return list(zip(data_encoders, nets, best_states))
+
+
+def regressionMetrics(label_predicted, labels, divided, WDNorm=False):
+    """ MSE, RMSE, MAE, negative gap, positive gap and Wasserstein distance
+    (the columns of packMetric) of the predictions
+    """
+    mse = mean_squared_error(label_predicted, labels)
+    gap_neg, gap_pos = valueGap(label_predicted, labels, divided)
+    if WDNorm:
+        wd = wasserstein_distance(
+            labels / np.sum(labels), label_predicted / np.sum(label_predicted)) * divided
+    else:
+        wd = wasserstein_distance(labels, label_predicted) * divided
+    return [
+        mse,
+        mse**0.5 * divided,
+        mean_absolute_error(label_predicted, labels) * divided,
+        gap_neg,
+        gap_pos,
+        wd,
+    ]
+
+
+# Data shared by the crossValJob calls of a process, set by initCrossValWorker
+_CROSSVAL_DATA = {}
+
+
+def initCrossValWorker(data, num_threads=None, backend=None):
+    """ Set the data of the cross validation jobs of this process
+    Args:
+        data: dict - X, Y, patient_name, X_test, y_test, feature_names, divided,
+            gaussianKDE and params (the parameters of the script)
+        num_threads: int - torch threads of the process (None: unchanged)
+        backend: str - matplotlib backend of the process (None: unchanged)
+    """
+    _CROSSVAL_DATA.clear()
+    _CROSSVAL_DATA.update(data)
+    if isinstance(data["gaussianKDE"], tuple):
+        # sent as (dataset, bandwidth factor), the kde itself does not pickle
+        dataset, factor = data["gaussianKDE"]
+        _CROSSVAL_DATA["gaussianKDE"] = sc.gaussian_kde(dataset, bw_method=factor)
+    # one float32 copy of the data for all the folds of the process
+    _CROSSVAL_DATA["folds"] = CrossValFolds(
+        data["X"], data["Y"], data["patient_name"], device=data["params"]["DEVICE"]
+    )
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if backend:
+        plt.switch_backend(backend)
+
+
+def crossValJob(seed, fold_idx):
+    """ One (seed, fold) job of script_FCNN_regression_CV.py: split, training,
+    runBestNet on the validation fold and on the test set, metrics and topGenes.
+    The best nets are saved under per (seed, fold) names (bestNetName) so that
+    jobs can run concurrently, the predictions are returned instead of written
+    (see saveLabelsPred).
+    Return:
+        res: dict - metrics rows, predictions, topGenes and the trained net (cpu)
+    """
+    d = _CROSSVAL_DATA
+    p = d["params"]
+    feature_names = d["feature_names"]
+    feature_len = len(feature_names)
+
+    start_time = time.time()
+    train_dl, test_dl, train_len, test_len, Ytest = d["folds"].fold(
+        seed, fold_idx, p["BATCH_SIZE"]
+    )
+    print(
+        "Len of train set: {}, Len of test set: {}".format(train_len, test_len)
+    )
+    print("----------- Start fold ", fold_idx, "----------------")
+    print("----------- Start Training ---------------")
+    data_encoder, net, best_state = training(seed, feature_len, p["TYPE_ACTIVATION"],
+                p["DEVICE"], p["n_hidden"], p["norm"], feature_names, p["GRADIENT_MASK"],
+                p["net_name"], p["LR"], p["criterion_regression"], train_dl,
+                train_len, d["gaussianKDE"], test_dl, test_len, p["outputPath"],
+                p["TYPE_PROJ"], p["SEEDS"], fold_idx, p["nfolds"], p["N_EPOCHS"],
+                p["N_EPOCHS_MASKGRAD"], p["DO_PROJ_MIDDLE"], p["ETA"], p["AXIS"], p["TOL"],
+                TARGET_FEATURES=p["TARGET_FEATURES"], VAL_EVERY=p["VAL_EVERY"],
+                COMPACT=p["COMPACT"], ETA_STAR=p["ETA_STAR"])
+    execution_time = time.time() - start_time
+    print(f"Execution time for training : {execution_time} seconds for fold {fold_idx}")
+    return crossValResult(fold_idx, data_encoder, net, best_state, test_dl, test_len,
+                          execution_time)
+
+
+def crossValStackedJob(group):
+    """crossValJob for a group of (seed, fold) jobs trained together as one
+    stacked model (trainingStacked)
+    Return:
+        results: list of the res dict of crossValJob, in the order of group
+    """
+    d = _CROSSVAL_DATA
+    p = d["params"]
+    feature_len = len(d["feature_names"])
+
+    start_time = time.time()
+    splits = [
+        d["folds"].fold(seed, fold_idx, p["BATCH_SIZE"]) for seed, fold_idx in group
+    ]
+    print("----------- Start Training of", group, "---------------")
+    trained = trainingStacked(
+        group, [(split[0], split[1]) for split in splits], p["outputPath"], feature_len,
+        p["TYPE_ACTIVATION"], p["DEVICE"], p["n_hidden"], p["norm"], p["GRADIENT_MASK"],
+        p["net_name"], p["LR"], p["criterion_regression"], p["TYPE_PROJ"], p["SEEDS"],
+        p["nfolds"], p["N_EPOCHS"], p["N_EPOCHS_MASKGRAD"], p["DO_PROJ_MIDDLE"],
+        p["ETA"], p["AXIS"], p["TOL"], TARGET_FEATURES=p["TARGET_FEATURES"],
+        VAL_EVERY=p["VAL_EVERY"], ETA_STAR=p["ETA_STAR"])
+    execution_time = time.time() - start_time
+    print(f"Execution time for training : {execution_time} seconds for {len(group)} folds")
+    return [
+        crossValResult(fold_idx, data_encoder, net, best_state, split[1], split[3],
+                       execution_time)
+        for (_, fold_idx), (data_encoder, net, best_state), split
+        in zip(group, trained, splits)
+    ]
+
+
+def crossValResult(fold_idx, data_encoder, net, best_state, test_dl, test_len,
+                   execution_time):
+    """Evaluation part of crossValJob once the net is trained"""
+    d = _CROSSVAL_DATA
+    p = d["params"]
+    X, Y = d["X"], d["Y"]
+    feature_names, divided = d["feature_names"], d["divided"]
+    feature_len = len(feature_names)
+    data_encoder = data_encoder.cpu().detach().numpy()
+
+    data_encoder_test, Ytrue, Ypred = runBestNet(
+        test_dl, p["outputPath"], fold_idx, net, feature_names, test_len, p["ETA"],
+        saveLabels=False, bestState=best_state,
+    )
+    data_encoder_test = data_encoder_test.cpu().detach().numpy()
+
+    # the inference below on the net without its dead neurons (same function)
+    net_eval, state_eval = net, best_state
+    if p["PRUNE"]:
+        net_eval = pruneNeurons(net, p["TOL"])
+        state_eval = net_eval.state_dict()
+    # or with its low rank layers as thin factors (same function)
+    if p["LOW_RANK"]:
+        net_eval = lowRankNet(net)
+        state_eval = net_eval.state_dict()
+        checkSameOutputs(net, net_eval, test_dl)
+
+    tps1 = time.perf_counter()
+    print("Running topGenes...")
+    df_topGenes = topGenes(
+        X, Y, feature_names, feature_len, p["method"], p["nb_samples"], p["DEVICE"],
+        net_eval, p["TOL"]
+    )
+    df_topGenes.index = df_topGenes.iloc[:, 0]
+    print("topGenes finished")
+    print("Execution time topGenes  : ", time.perf_counter() - tps1)
+
+    sparsity = None
+    if p["DoSparsity"]:
+        sparsity = sparsity_col(inputWeight(net), device=p["DEVICE"])
+
+    print("---------------- Start Testing on the 20% ----------------")
+    test_dl20, test_len20 = TestSet(
+        d["X_test"], d["y_test"], list(range(len(d["X_test"]))), device=p["DEVICE"]
+    )
+    dtest = test_dl20.dataset
+    print("Len of test set: {}".format(test_len20))
+    if p["SPARSE_THRESHOLD"] is not None:
+        net_eval = sparseNet(net_eval, p["SPARSE_THRESHOLD"])
+        state_eval = net_eval.state_dict()
+    data_encoder_test20, Ytrue20, Ypred20 = runBestNet(
+        test_dl20, p["outputPath"], fold_idx, net_eval, feature_names, test_len, p["ETA"],
+        saveLabels=False, bestState=state_eval,
+    )
+    data_encoder_test20 = data_encoder_test20.cpu().detach().numpy()
+
+    return {
+        "data_train": regressionMetrics(
+            data_encoder[:, 0], data_encoder[:, -1], divided, p["WDNorm"]),
+        "data_test": regressionMetrics(
+            data_encoder_test[:, 0], data_encoder_test[:, -1], divided, p["WDNorm"]),
+        "data_finalTest": regressionMetrics(
+            data_encoder_test20[:, 0], data_encoder_test20[:, -1], divided, p["WDNorm"]),
+        "data_encoder_test": data_encoder_test,
+        "Ytrue": Ytrue,
+        "Ypred": Ypred,
+        "labels": [list(x) for x in zip(test_dl.dataset.ind, Ytrue, Ypred)],
+        "Ytrue20": Ytrue20,
+        "Ypred20": Ypred20,
+        "labels20": [list(x) for x in zip(dtest.ind, Ytrue20, Ypred20)],
+        "df_topGenes": df_topGenes,
+        "sparsity": sparsity,
+        "net": net.cpu(),
+        "execution_time": execution_time,
+    }
+
+
+def crossValTask(group, STACK_MODELS=None):
+    """Results of a group of jobs, trained as one stacked model if STACK_MODELS"""
+    if STACK_MODELS:
+        return crossValStackedJob(group)
+    return [crossValJob(*job) for job in group]
+
+
+def runCrossValJobs(jobs, data, NUM_WORKERS=1, num_threads=None, STACK_MODELS=None):
+    """ Run the crossValJob of every (seed, fold) of jobs, serially if
+    NUM_WORKERS <= 1 else in a pool of NUM_WORKERS processes (spawn) with
+    num_threads torch threads each. The results are in the order of jobs
+    and do not depend on NUM_WORKERS: training() reseeds every job.
+    STACK_MODELS trains the jobs as stacked models (crossValStackedJob):
+    None (one model per job), "folds" (the folds of each seed) or "all".
+    """
+    if STACK_MODELS is None:
+        groups = [[job] for job in jobs]
+    elif STACK_MODELS == "folds":
+        groups = [list(group) for _, group in itertools.groupby(jobs, key=lambda job: job[0])]
+    elif STACK_MODELS == "all":
+        groups = [list(jobs)]
+    else:
+        raise ValueError(
+            "STACK_MODELS '{}' is not one of None, 'folds', 'all'".format(STACK_MODELS)
+        )
+
+    if data["params"]["LOW_RANK"] and data["params"]["PRUNE"]:
+        raise ValueError(
+            "LOW_RANK and PRUNE cannot be combined: pruneNeurons does not handle "
+            "the LowRankLinear layers of lowRankNet"
+        )
+
+    if NUM_WORKERS <= 1:
+        initCrossValWorker(data, num_threads)
+        return [res for group in groups for res in crossValTask(group, STACK_MODELS)]
+    kde = data["gaussianKDE"]
+    data = dict(data, gaussianKDE=(kde.dataset, kde.factor))
+    ctx = torch.multiprocessing.get_context("spawn")
+    with ctx.Pool(
+        NUM_WORKERS, initializer=initCrossValWorker, initargs=(data, num_threads, "Agg")
+    ) as pool:
+        results = pool.starmap(crossValTask, [(group, STACK_MODELS) for group in groups])
+    return [res for group_results in results for res in group_results]
+
+
+def buildNet(feature_len, TYPE_ACTIVATION, net_name, DEVICE, n_hidden, norm ):
+    if net_name == "LeNet":
+        net = LeNet_300_100(n_inputs=feature_len, n_outputs=1, activation=TYPE_ACTIVATION).to(
+            DEVICE
+        )  # LeNet
+    if net_name == "netBio":
+        net = netBio(feature_len, 1, n_hidden, activation=TYPE_ACTIVATION, norm = norm).to(DEVICE)  # netBio
+
+    if net_name == "FAIR":
+        net = FairAutoEncoder(feature_len, 1, n_hidden, activation=TYPE_ACTIVATION, norm = norm).to(DEVICE)  # netBio
+
+    if net_name == "dnn":
+        net = DNN(feature_len, n_hidden, 0.1, ratio = False).to(DEVICE)  # netBio
+    return net
+
+
+def selectf(x, feature_name):
+    x = x.cpu()
+    _, d = x.shape
+    mat = []
+    lenmax = min(len(feature_name), d) 
+    for i in range(lenmax):
+        mat.append([feature_name[i] + "", np.linalg.norm(x[:, i])])
     mat = sorted(mat, key=lambda norm: norm[1], reverse=True)
     columns = ["Genes", "Weights"]
     res = pd.DataFrame(mat)
@@ -1659,20 +3207,33 @@ def runBestNet(
     feature_name,
     test_len,
     ETA,
-    SnormGenes=True
+    SnormGenes=True,
+    netName="best_net",
+    saveLabels=True,
+    bestState=None,
 ):
     """ Load the best net and test it on your test set 
     Attributes:
         train_dl, test_dl: train(test) sets
         outputPath: patch to load the net weights 
+        netName: file name of the net weights in outputPath
+        saveLabels: write the predictions with saveLabelsPred
+        bestState: state_dict of the best net (as returned by training()),
+            used instead of loading netName
     Return:
 
         class_test: accuracy of each class for testing       
     """
-    Y_predit = []
-    Y_true = []
-    index_pred_probs = []
-    net.load_state_dict(torch.load(str(outputPath) + "best_net", weights_only=True))
+    if not getattr(test_dl, "return_names", True):
+        raise ValueError(
+            "runBestNet needs the sample names of the batches, create the {} "
+            "with return_names=True".format(type(test_dl).__name__)
+        )
+    predictions = PredictionCollector(len(test_dl.dataset))
+    indices = []
+    if bestState is None:
+        bestState = torch.load(str(outputPath) + netName, weights_only=True)
+    net.load_state_dict(bestState)
     net.eval()
     # for i, batch in enumerate(train_dl):
     #     x = batch[0]
@@ -1683,32 +3244,39 @@ def runBestNet(
     #     encoder_out, decoder_out = net(x)
     #     loss_classification = nn.MSELoss(encoder_out.flatten(), labels)
           
-    first = True
     for i, batch in enumerate(test_dl):
         with torch.no_grad():
             x = batch[0]
             labels = batch[1]
-            index = batch[2]
             if torch.cuda.is_available():
                 x = x.cuda()
                 labels = labels.cuda()
             encoder_out = net(x)
-            index_pred_probs.append(
-                [index[0], labels.item()]
-                + encoder_out.detach().cpu().numpy().tolist()[0]
-            )
-            Y_predit.append(encoder_out.flatten().item())
-            Y_true.append(labels.item())
+            predictions.add(encoder_out, labels)
+            indices.extend(batch[2])
 
-            if first:
-                data_encoder = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
+    data_encoder = predictions.result()
+    rows = data_encoder.cpu().tolist()
+    index_pred_probs = [[index, row[-1]] + row[:-1] for index, row in zip(indices, rows)]
+    Y_predit = [row[0] for row in rows]
+    Y_true = [row[-1] for row in rows]
 
-                first = False
-            else:
-                tmp2 = torch.cat((encoder_out, labels.view(-1, 1)), dim=1)
-                data_encoder = torch.cat((data_encoder, tmp2), dim=0)
+    if saveLabels:
+        saveLabelsPred(index_pred_probs, outputPath, nfold, ETA)
+   
+    return (
+        data_encoder,
+        Y_true,
+        Y_predit,
+    )
 
-    
+
+def saveLabelsPred(index_pred_probs, outputPath, nfold, ETA):
+    """ Write the predictions of runBestNet to Labelspred_value<ETA>.csv,
+    appended to the previous folds unless nfold is 0
+    Attributes:
+        index_pred_probs: list of [name, initial value, predicted value]
+    """
     try:
         if nfold != 0:
             df = pd.read_csv(
@@ -1737,13 +3305,6 @@ def runBestNet(
         )
         soft.to_csv("{}Labelspred_value{}.csv".format(outputPath, ETA), sep=";", index=0, float_format='%g')
 
-    
-   
-    return (
-        data_encoder,
-        Y_true,
-        Y_predit,
-    )
 
 def valueGap (true, predicted, divided):
     """
@@ -1834,6 +3395,101 @@ def packMetricsResult(data_train, data_test, fold_nb):
     return df_metricsTrain, df_metricsTest
 
 
+def nuclearFactors(w, eta_star=None, rtol=1e-5, device="cpu"):
+    """Thin factors of the matrix w from its SVD: left @ right is w truncated
+    at its numerical rank r (the singular values above rtol times the largest
+    one), or, if eta_star is given, proj_nuclear of w (r the number of
+    singular values kept by the projection on the l1 ball)
+    Return:
+        left: tensor (out x r) - singular vectors scaled by the singular values
+        right: tensor (r x in)
+    """
+    w = torch.as_tensor(w, dtype=torch.get_default_dtype(), device=device)
+    L, S0, R = torch.svd(w, some=True)  #'economy-size decomposition'
+    if eta_star is None:
+        v_star = torch.where(S0 > rtol * S0[0], S0, torch.zeros_like(S0))
+    else:
+        v_star = proj_l1ball(S0, eta_star, device=S0.device)
+    rank = int(torch.count_nonzero(v_star))  # the largest singular values
+    return L[:, :rank] * v_star[:rank], R[:, :rank].t()
+
+
+class LowRankLinear(nn.Module):
+    """Linear layer of rank r as two thin Linear layers: factor_in (in -> r)
+    then factor_out (r -> out, with the bias), 2 r (in + out) flops per
+    sample instead of 2 in out (see lowRankNet).
+
+    Attributes:
+        factor_in: nn.Linear - right factor, without bias
+        factor_out: nn.Linear - left factor and bias
+    """
+
+    def __init__(self, left, right, bias=None):
+        super().__init__()
+        # the initialization must not move the seeded generator (see compactNet)
+        with torch.random.fork_rng(devices=[]):
+            self.factor_in = nn.Linear(right.shape[1], right.shape[0], bias=False)
+            self.factor_out = nn.Linear(left.shape[1], left.shape[0], bias=bias is not None)
+        self.to(left.device)
+        with torch.no_grad():
+            self.factor_in.weight.copy_(right)
+            self.factor_out.weight.copy_(left)
+            if bias is not None:
+                self.factor_out.bias.copy_(bias)
+        self.in_features, self.out_features = right.shape[1], left.shape[0]
+
+    def forward(self, x):
+        return self.factor_out(self.factor_in(x))
+
+
+def lowRankNet(net, rtol=1e-5):
+    """Copy of net where every Linear layer whose numerical rank is low enough
+    for the factors to be cheaper is replaced by a LowRankLinear, from the
+    truncated SVD of its weight (see nuclearFactors). The weights are not
+    projected: the net computes the same function up to the singular values
+    below rtol times the largest one of each layer. The layers of a net
+    projected with proj_nuclear are low rank, unless retrained afterwards.
+    Args:
+        net: nn.Module - the net
+        rtol: float - relative threshold of the numerical rank
+    Return:
+        lowrank: nn.Module - the factorized net
+    """
+    lowrank = copy.deepcopy(net)
+    layers = [(name, module) for name, module in lowrank.named_modules()
+              if type(module) is nn.Linear]
+    for name, layer in layers:
+        weight = layer.weight.detach()
+        left, right = nuclearFactors(weight, rtol=rtol, device=weight.device)
+        n_out, n_in = weight.shape
+        if left.shape[1] * (n_in + n_out) < n_in * n_out:
+            bias = None if layer.bias is None else layer.bias.detach()
+            parent, _, child = name.rpartition(".")
+            setattr(lowrank.get_submodule(parent), child,
+                    LowRankLinear(left.to(weight.dtype), right.to(weight.dtype), bias))
+    return lowrank
+
+
+def checkSameOutputs(net, other, loader, tol=1e-4):
+    """Raise a RuntimeError if the outputs of net and other (a transformed
+    copy, as lowRankNet) on the batches of loader differ by more than tol
+    relative to the largest output"""
+    error, scale = 0.0, 1.0
+    net.eval()
+    other.eval()
+    with torch.no_grad():
+        for batch in loader:
+            out = net(batch[0])
+            error = max(error, (out - other(batch[0])).abs().max().item())
+            scale = max(scale, out.abs().max().item())
+    if error > tol * scale:
+        raise RuntimeError(
+            "the outputs of the transformed net differ by {} (tolerance {})".format(
+                error, tol * scale)
+        )
+    return error
+
+
 def Projection(
     W, TYPE_PROJ=proj_l11ball, ETA=100,  AXIS=0, ETA_STAR=100, device="cpu", TOL=1e-3
 ):
@@ -1859,19 +3515,54 @@ def Projection(
         W_new = TYPE_PROJ(W, ETA, device)
     if TYPE_PROJ == proj_l12ball:
         W_new = TYPE_PROJ(W, ETA, AXIS, device=device)
-    if TYPE_PROJ == proj_l1Inftyball_line_unbounded:
-        W_new = TYPE_PROJ(W, ETA, device=device)  
+    if (
+        TYPE_PROJ == proj_l1Inftyball_line
+        or TYPE_PROJ == proj_l1Inftyball_line_unbounded
+    ):
+        W_new = TYPE_PROJ(W, ETA, device=device)
     if TYPE_PROJ == proj_l1infball:
         
         W_new = TYPE_PROJ(W, ETA, AXIS, device=device, tol=TOL)
     if TYPE_PROJ == bilevel_proj_l1Inftyball:
-        W_new = TYPE_PROJ(W, ETA, device)  
+        W_new = TYPE_PROJ(W, ETA, device, AXIS=AXIS)
         
     if TYPE_PROJ == proj_nuclear:
         W_new = TYPE_PROJ(W, ETA_STAR, device=device)
     return W_new
 
 
+def projectNet(
+    net, TYPE_PROJ, ETA, DO_PROJ_MIDDLE=False, ETA_STAR=100, TOL=1e-3, AXIS=0,
+    TARGET_FEATURES=None, device="cpu"
+):
+    """ Project the parameters of the net (ProjectionLastEpoch), in place
+    Args:
+        net: nn.Module - the net to project
+        TYPE_PROJ: function - the projection
+        ETA: float - the projection radius
+        DO_PROJ_MIDDLE: bool - whether to project the middle layer
+        TARGET_FEATURES: int - if not None, radius of the first layer computed
+            to keep this number of features (bilevel_proj_l1Inftyball)
+    """
+    net_parameters = list(net.parameters())
+    for index, param in enumerate(net_parameters):
+        is_middle = index == len(net_parameters) / 2 - 1
+        # if (
+        #     DO_PROJ_MIDDLE == False and is_middle
+        # ):  # Do no projection at middle layer
+        #     print(
+        #         f"Did not project layer {index} ({param.shape}) because: middle"
+        #     )
+        if( DO_PROJ_MIDDLE == True or not is_middle ) :
+                eta = ETA
+                if TARGET_FEATURES is not None and index == 0:
+                    eta = eta_for_target_features(
+                        param.data, TARGET_FEATURES, AXIS=AXIS, tol=TOL, device=device)
+                    print(f"ETA for {TARGET_FEATURES} features = {eta}")
+                param.data = Projection(
+                    param.data, TYPE_PROJ, eta,  AXIS=AXIS, ETA_STAR=ETA_STAR, device=device, TOL=TOL,).to(device)
+
+
 def ShowPcaTsne(X, Y, data_encoder, center_distance, class_len, tit):
     """ Visualization with PCA and Tsne
     Args:
@@ -2192,7 +3883,7 @@ def sparsity_line(M, tol=1.0e-3, device="cpu"):
     if type(M) is not torch.Tensor:
         M = torch.as_tensor(M, device=device)
     M1 = torch.where(torch.abs(M) < tol, torch.zeros_like(M), M)
-    M1_sum = torch.sum(M1, 1)
+    M1_sum = torch.sum(torch.abs(M1), 1)
     nb_nonzero = len(M1_sum.nonzero())
     return (1.0 - nb_nonzero / M1.shape[0]) * 100
 
@@ -2212,7 +3903,7 @@ def sparsity_col(M, tol=1.0e-3, device="cpu"):
     if type(M) is not torch.Tensor:
         M = torch.as_tensor(M, device=device)
     M1 = torch.where(torch.abs(M) < tol, torch.zeros_like(M), M)
-    M1_sum = torch.sum(M1, 0)
+    M1_sum = torch.sum(torch.abs(M1), 0)
     nb_nonzero = len(M1_sum.nonzero())
     return (1.0 - nb_nonzero / M1.shape[1]) * 100
 
@@ -2243,28 +3934,25 @@ def removedf(dataframe, keepDF):
 
 from sklearn.preprocessing import scale as scale
 
-def ReadData(
-    file_name, doScale=True, doLog=True, doRowNorm = False, doMeanto1 = False
-):
-    try:
-        data_pd = pd.read_csv(
-            "../../data/" + str(file_name),
-            delimiter=";",
-            decimal=",",
-            header=0,
-            encoding="ISO-8859-1",
-            low_memory=False,
-        )
-    except:
-        data_pd = pd.read_csv(
-            "datas/" + str(file_name),
-            delimiter=";",
-            decimal=",",
-            header=0,
-            encoding="ISO-8859-1",
-            low_memory=False,
-        )
-   
+def dataPath(file_name):
+    """Path of file_name, looked up in ../../data/, in datas/ then as is"""
+    for path in ("../../data/" + str(file_name), "datas/" + str(file_name)):
+        if os.path.exists(path):
+            return path
+    return str(file_name)
+
+
+def readDataFile(file_name):
+    """Parse a feature-major csv file: X (samples x features), raw Y,
+    feature names and patient names"""
+    data_pd = pd.read_csv(
+        dataPath(file_name),
+        delimiter=";",
+        decimal=",",
+        header=0,
+        encoding="ISO-8859-1",
+        low_memory=False,
+    )
     X = (data_pd.iloc[1:, 1:].values.astype(float)).T
     Y = data_pd.iloc[0, 1:].values.astype(float).astype(np.int64)
     col = data_pd.columns.to_list()
@@ -2272,29 +3960,319 @@ def ReadData(
         col[0] = "Name"
     data_pd.columns = col
     feature_name = data_pd["Name"].values.astype(str)[1:]
-    label_name = np.unique(Y)
     patient_name = data_pd.columns[1:]
-    # Do standardization
-    if doLog:
-        X = np.log(abs(X + 1))  # Transformation
+    return X, Y, feature_name, patient_name
+
+
+def readDataFast(file_name, num_threads=None, chunk_size=1 << 22, verbose=True):
+    """Parse a feature-major csv file like readDataFile, without the object
+    frame: chunks of feature rows (about chunk_size bytes) are parsed in
+    parallel threads directly into a preallocated sample-major float32 X.
+    Decimals can be "," or "." """
+    path = dataPath(file_name)
+    t1 = time.perf_counter()
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = data.find(b"\n") + 1
+        patient_name = pd.Index(
+            data[:start].decode("ISO-8859-1").rstrip("\r\n").split(";")[1:]
+        )
+        n_samples = len(patient_name)
+        end = data.find(b"\n", start) + 1
+        labels = data[start:end].decode("ISO-8859-1").rstrip("\r\n").split(";")[1:]
+        Y = np.array([float(v.replace(",", ".")) for v in labels]).astype(np.int64)
+
+        # chunks of whole lines, with their first row
+        stop = len(data)
+        while stop > end and data[stop - 1 : stop].isspace():
+            stop -= 1
+        bounds = [end]
+        while bounds[-1] < stop:
+            nxt = data.find(b"\n", min(bounds[-1] + chunk_size, stop))
+            bounds.append(stop if nxt < 0 or nxt >= stop else nxt + 1)
+        first_rows = [0]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            first_rows.append(first_rows[-1] + data[a:b].count(b"\n") + (b == stop))
+        n_features = first_rows[-1]
+
+        X = np.empty((n_samples, n_features), dtype=np.float32)
+        feature_name = np.empty(n_features, dtype=object)
+
+        def parse(i):
+            lines = data[bounds[i] : bounds[i + 1]].rstrip(b"\r\n").split(b"\n")
+            names, values = zip(*(line.rstrip(b"\r").split(b";", 1) for line in lines))
+            rows = slice(first_rows[i], first_rows[i + 1])
+            feature_name[rows] = [name.decode("ISO-8859-1") for name in names]
+            # one value per line: a single column for the C parser, which
+            # runs without the GIL
+            values = b"\n".join(values).replace(b";", b"\n").replace(b",", b".")
+            chunk = pd.read_csv(
+                io.BytesIO(values),
+                delimiter=";",
+                header=None,
+                names=[0],
+                dtype=np.float32,
+                skip_blank_lines=False,
+            )
+            X[:, rows] = chunk[0].to_numpy().reshape(len(lines), n_samples).T
 
-    X = X - np.mean(X, axis=0)
-    if doScale:
-        X = scale(X, axis=0)  # Standardization along rows
-    if doMeanto1:
-        X = X - np.mean(X, axis = 0)
+        with ThreadPoolExecutor(num_threads or os.cpu_count()) as pool:
+            list(pool.map(parse, range(len(bounds) - 1)))
+        size = len(data)
+    finally:
+        data.close()
+
+    if verbose:
+        elapsed = time.perf_counter() - t1
+        print(
+            "Read {}: {:.1f} MB in {:.2f} s ({:.1f} MB/s), X {:.1f} MB{}".format(
+                file_name, size / 2**20, elapsed, size / 2**20 / elapsed,
+                X.nbytes / 2**20, peakMemory(),
+            )
+        )
+    return X, Y, feature_name.astype(str), patient_name
+
+
+def peakMemory():
+    """Peak resident memory of the process, as a string to print"""
+    if resource is None:
+        return ""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":  # kilobytes on Linux
+        peak *= 1024
+    return ", peak RSS {:.1f} MB".format(peak / 2**20)
+
+
+def selectData(X, Y, feature_name, patient_name, features=None, samples=None):
+    """Keep the given features and samples (names), in the given order"""
+    if features is not None:
+        cols = pd.Index(feature_name).get_indexer(features)
+        if (cols < 0).any():
+            raise KeyError("Unknown features: {}".format(np.asarray(features)[cols < 0]))
+        X, feature_name = X[:, cols], np.asarray(feature_name)[cols]
+    if samples is not None:
+        rows = pd.Index(patient_name).get_indexer(samples)
+        if (rows < 0).any():
+            raise KeyError("Unknown samples: {}".format(np.asarray(samples)[rows < 0]))
+        X, Y, patient_name = X[rows], Y[rows], pd.Index(patient_name)[rows]
+    return X, Y, feature_name, patient_name
+
+
+def requireParquet():
+    if pq is None:
+        raise ImportError("Use '!pip install pyarrow' to read and write parquet files")
+
+
+def csvToParquet(file_name, parquet_name=None, num_threads=None):
+    """Convert a feature-major csv file to a sample-major parquet file with
+    the columns Name (patient), Label and one float32 column per feature.
+    The file is written next to the csv, with the .parquet extension"""
+    requireParquet()
+    X, Y, feature_name, patient_name = readDataFast(file_name, num_threads=num_threads)
+    if parquet_name is None:
+        parquet_name = os.path.splitext(dataPath(file_name))[0] + ".parquet"
+    table = pa.Table.from_arrays(
+        [pa.array(np.asarray(patient_name, dtype=str)), pa.array(Y)]
+        + [pa.array(X[:, j]) for j in range(X.shape[1])],
+        names=["Name", "Label"] + list(feature_name),
+    )
+    pq.write_table(table, parquet_name)
+    return parquet_name
+
+
+def readDataParquet(file_name, features=None, samples=None):
+    """Read a file written by csvToParquet like readDataFile; only the
+    columns of the given features and the row groups holding the given
+    samples are read"""
+    requireParquet()
+    path = dataPath(file_name)
+    if features is None:
+        features = [c for c in pq.read_schema(path).names if c not in ("Name", "Label")]
+    table = pq.read_table(
+        path,
+        columns=["Name", "Label"] + list(features),
+        filters=None if samples is None else [("Name", "in", list(samples))],
+    )
+    X = np.empty((table.num_rows, len(features)), dtype=np.float32)
+    for j, feature in enumerate(features):
+        X[:, j] = table.column(feature).to_numpy()
+    Y = table.column("Label").to_numpy().astype(np.int64)
+    patient_name = pd.Index(table.column("Name").to_pylist())
+    return selectData(X, Y, np.asarray(features, dtype=str), patient_name, samples=samples)
+
+
+class Preprocessor:
+    """Preprocessing of ReadData fitted on the training data: log transform,
+    centering, scaling, row normalization of X and scaling of the labels.
+    transform applies the fitted statistics to any batch of new samples and
+    save / load keep them next to the model for inference.
+
+    Attributes:
+        doScale, doLog, doRowNorm, doMeanto1: bool - the ReadData flags
+        mean: np.ndarray - subtracted from each feature (None if not fitted)
+        std: np.ndarray - divides each feature after centering (doScale)
+        divided: float - power of 10 dividing the labels
+    """
+
+    FLAGS = ("doScale", "doLog", "doRowNorm", "doMeanto1")
+
+    def __init__(self, doScale=True, doLog=True, doRowNorm=False, doMeanto1=False):
+        self.doScale = doScale
+        self.doLog = doLog
+        self.doRowNorm = doRowNorm
+        self.doMeanto1 = doMeanto1
+        self.mean = None
+        self.std = None
+        self.divided = None
+
+    @property
+    def fitted(self):
+        return self.mean is not None
+
+    def log(self, X):
+        return np.log(abs(X + 1)) if self.doLog else X
+
+    def fit(self, X, Y=None):
+        X = self.log(np.asarray(X, dtype=np.float64))
+        self.mean = X.mean(axis=0)
+        self.std = np.ones_like(self.mean)
+        X = X - self.mean
+        if self.doScale:  # as sklearn.preprocessing.scale
+            mean = X.mean(axis=0)
+            std = X.std(axis=0)
+            std[std < 10 * np.finfo(std.dtype).eps] = 1.0
+            X = (X - mean) / std
+            self.mean += mean
+            self.std = std
+        if self.doMeanto1:
+            self.mean += self.std * X.mean(axis=0)
+        if Y is not None:
+            self.divided = math.pow(10, 1 + math.floor(math.log10(np.max(np.abs(Y)))))
+        return self
+
+    def transform(self, X):
+        """Preprocessed X (samples x features), in the dtype of X if float"""
+        X = self.log(np.asarray(X))
+        dtype = X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64
+        X = X - self.mean.astype(dtype)
+        if self.doScale:
+            X /= self.std.astype(dtype)
+        if self.doRowNorm:
+            X -= np.mean(X, axis=1, keepdims=True)
+        return X
+
+    def transformLabels(self, Y):
+        return np.asarray(Y) / self.divided
+
+    def inverseLabels(self, Y):
+        return np.asarray(Y) * self.divided
+
+    def save(self, path):
+        np.savez(
+            path, mean=self.mean, std=self.std, divided=np.nan if self.divided is None else self.divided,
+            **{flag: getattr(self, flag) for flag in self.FLAGS},
+        )
+
+    def load(self, path):
+        """Set the flags and the statistics saved in path, returns self"""
+        with np.load(path) as saved:
+            for flag in self.FLAGS:
+                setattr(self, flag, bool(saved[flag]))
+            self.mean = saved["mean"]
+            self.std = saved["std"]
+            self.divided = None if np.isnan(saved["divided"]) else float(saved["divided"])
+        return self
+
+
+def dataCachePath(file_name, preprocessor, features=None, samples=None):
+    """Cache directory of the preprocessed file_name, keyed by the content
+    of the file, the preprocessing (flags and fitted statistics if any) and
+    the selected features/samples"""
+    path = dataPath(file_name)
+    key = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            key.update(chunk)
+    key.update(repr(tuple(getattr(preprocessor, flag) for flag in Preprocessor.FLAGS)).encode())
+    if preprocessor.fitted:
+        key.update(preprocessor.mean.tobytes() + preprocessor.std.tobytes())
+        key.update(repr(preprocessor.divided).encode())
+    for names in (features, samples):
+        if names is not None:
+            key.update(";".join(map(str, names)).encode())
+        key.update(b"\n")
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(
+        os.path.dirname(path), "cache", "{}_{}".format(stem, key.hexdigest())
+    )
+
+
+def saveDataCache(cachePath, X, Y, feature_name, patient_name, preprocessor):
+    """Write the preprocessed data and its preprocessor to cachePath
+    (X in float32)"""
+    tmpPath = "{}.tmp{}".format(cachePath, os.getpid())
+    os.makedirs(tmpPath, exist_ok=True)
+    np.save(os.path.join(tmpPath, "X.npy"), np.ascontiguousarray(X, dtype=np.float32))
+    np.save(os.path.join(tmpPath, "Y.npy"), np.asarray(Y, dtype=np.int64))
+    np.save(os.path.join(tmpPath, "feature_name.npy"), np.asarray(feature_name, dtype=str))
+    np.save(os.path.join(tmpPath, "patient_name.npy"), np.asarray(patient_name, dtype=str))
+    preprocessor.save(os.path.join(tmpPath, "preprocessor.npz"))
+    try:
+        os.rename(tmpPath, cachePath)
+    except OSError:  # written meanwhile by another run
+        shutil.rmtree(tmpPath, ignore_errors=True)
+
+
+def loadDataCache(cachePath):
+    """Read the data written by saveDataCache, X is memory-mapped
+    (copy-on-write)"""
+    X = np.load(os.path.join(cachePath, "X.npy"), mmap_mode="c")
+    Y = np.load(os.path.join(cachePath, "Y.npy"))
+    feature_name = np.load(os.path.join(cachePath, "feature_name.npy"))
+    patient_name = pd.Index(np.load(os.path.join(cachePath, "patient_name.npy")))
+    return X, Y, feature_name, patient_name
+
+
+def ReadData(
+    file_name, doScale=True, doLog=True, doRowNorm = False, doMeanto1 = False,
+    doCache = False, doFastRead = False, features = None, samples = None,
+    preprocessor = None
+):
+    """Read and preprocess file_name (csv or parquet). With doCache the
+    preprocessed data is stored in float32 next to the file (cache/) and
+    loaded from there on the next runs. doFastRead parses the csv with
+    readDataFast. features / samples keep only these names.
+    A Preprocessor that is not fitted yet is fitted on this file (its flags
+    replace doScale, doLog...); a fitted one is only applied, e.g. the one
+    of the training file to the test file"""
+    if preprocessor is None:
+        preprocessor = Preprocessor(doScale, doLog, doRowNorm, doMeanto1)
+
+    def read(file_name):
+        if str(file_name).endswith(".parquet"):
+            X, Y, feature_name, patient_name = readDataParquet(file_name, features, samples)
+        else:
+            X, Y, feature_name, patient_name = selectData(
+                *(readDataFast if doFastRead else readDataFile)(file_name), features, samples
+            )
+        if not preprocessor.fitted:
+            preprocessor.fit(X, Y)
+        return preprocessor.transform(X), Y, feature_name, patient_name
+
+    if doCache:
+        cachePath = dataCachePath(file_name, preprocessor, features, samples)
+        if not os.path.exists(cachePath):
+            saveDataCache(cachePath, *read(file_name), preprocessor)
+        elif not preprocessor.fitted:
+            preprocessor.load(os.path.join(cachePath, "preprocessor.npz"))
+        X, Y, feature_name, patient_name = loadDataCache(cachePath)
+    else:
+        X, Y, feature_name, patient_name = read(file_name)
+    label_name = np.unique(Y)
+    Y = preprocessor.transformLabels(Y)
+    divided = preprocessor.divided
 
-    if doRowNorm: 
-        X = X - np.mean(X,axis = 1, keepdims = True)
-        
-    
-    newY=[0]*len(Y)
-    divided = 0
-    for i in range(len(Y)):
-        divided= math.pow(10,(1 + math.floor( math.log10( Y[i] ) )))
-        newY[i]=Y[i]/ divided
-    Y=np.array(newY)
-    
     gaussianKDE=sc.gaussian_kde(Y, bw_method=0.2)
     return X, Y, feature_name, label_name, patient_name, gaussianKDE, divided
 
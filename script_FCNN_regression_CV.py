@@ -30,8 +30,6 @@ import numpy as np
 import seaborn as sns
 import torch
 from torch import nn
-from sklearn import metrics
-from scipy.stats import wasserstein_distance
 
 import functions.functions_torch_regression_V4 as ft
 import functions.functions_network_pytorch as fnp
@@ -54,6 +52,7 @@ if __name__ == "__main__":
     N_EPOCHS_MASKGRAD = 40  # Number of epochs for training masked gradient
     LR = 0.0005  # Learning rate
     BATCH_SIZE = 50  # Optimize the trade off between accuracy and computational time
+    VAL_EVERY = 1  # Validate (and keep the best net) every VAL_EVERY epochs
 
     # unit scaling of the input data
     doScale = False
@@ -62,6 +61,10 @@ if __name__ == "__main__":
     #row normalization of the input data
     doRowNorm = False
     doMeanto1 = False
+    # cache the preprocessed data (datas/cache/) for the next runs
+    doCache = True
+    # parse the csv with the threaded float32 reader (ft.readDataFast)
+    doFastRead = True
     
     #distribution normalisation for Wasserstein
     WDNorm = False
@@ -94,7 +97,25 @@ if __name__ == "__main__":
     DO_PROJ_MIDDLE = False
 
     ETA = 1 # Controls feature selection (projection) (L1, L11, L21)
+    ETA_STAR = 100 # Radius of the nuclear norm ball (proj_nuclear)
+    # Number of features to select, if not None ETA of the first layer is
+    # computed to keep exactly this number of features (bilevel l1,inf only)
+    TARGET_FEATURES = None
     GRADIENT_MASK = True # Whether to do a second descent
+    # Remove the features discarded by the projection from the first layer
+    # before the second descent (ft.compactNet), not with STACK_MODELS
+    COMPACT = True
+    # Remove the dead neurons (zero rows, AXIS=0) of the hidden layers for the
+    # inference on the test sets and topGenes (ft.pruneNeurons)
+    PRUNE = True
+    # Layers with at least this share of zero weights run as CSR sparse
+    # products on the final test when faster (ft.sparseNet), None for dense
+    SPARSE_THRESHOLD = 0.9
+    # Low rank layers (as after proj_nuclear) run as two thin factors for
+    # topGenes and the inference on the final test, same outputs (ft.lowRankNet),
+    # not with PRUNE. The second descent (GRADIENT_MASK) retrains the projected
+    # weights densely, which usually gives them back their full rank
+    LOW_RANK = False
 
     ## Choose projection function
     if not GRADIENT_MASK:
@@ -107,6 +128,7 @@ if __name__ == "__main__":
         #TYPE_PROJ = ft.proj_l21ball   # projection l21
         #TYPE_PROJ = ft.proj_l1infball  # projection l1,inf
         TYPE_PROJ = ft.bilevel_proj_l1Inftyball  # projection bilevel l1,inf
+        #TYPE_PROJ = ft.proj_nuclear  # projection nuclear norm (ETA_STAR)
 
         TYPE_PROJ_NAME = TYPE_PROJ.__name__
         
@@ -119,12 +141,25 @@ if __name__ == "__main__":
     TOL = 1e-3  # error margin for the L1inf algorithm and gradient masking
 
     DoTopGenes = True  # Compute feature rankings
+    # method = 'Shap'   # (SHapley Additive exPlanation) needs a nb_samples
+    nb_samples = 300  # Randomly choose nb_samples to calculate their Shap Value, time vs nb_samples seems exponential
+    # method = 'Captum_ig'   # Integrated Gradients
+    method = "Captum_dl"  # Deeplift
+    # method = 'Captum_gs'  # GradientShap
     
     DoSparsity= True # Show the sparsity of the SAE
 
     # Save Results or not
     SAVE_FILE = True
 
+    # Parallel (seed, fold) jobs: number of worker processes (1 = serial run)
+    # and torch threads per worker (None = torch default)
+    NUM_WORKERS = 1
+    NUM_THREADS = None
+    # Train several folds at once as one stacked (batched) model:
+    # None, "folds" (the folds of each seed) or "all" (every seed and fold)
+    STACK_MODELS = None
+
     ######## Main routine ########
     
     # Output Path
@@ -146,14 +181,18 @@ if __name__ == "__main__":
     if not os.path.exists(plotPath):  # make the directory if it does not exist
         os.makedirs(plotPath)
 
-    # Load data
+    # Load data, the preprocessing is fitted on the training file and
+    # applied as is to the test file (and saved for inference)
+    preprocessor = ft.Preprocessor(doScale=doScale, doLog=doLog, doRowNorm=doRowNorm,
+                                   doMeanto1=doMeanto1)
     X, Y,  feature_names, label_name_train,  patient_name, gaussianKDE , divided = ft.ReadData(
-        file_name, doScale=doScale, doLog=doLog,  doRowNorm = doRowNorm, doMeanto1 = doMeanto1
+        file_name, doCache = doCache, doFastRead = doFastRead, preprocessor = preprocessor
     )
     
     X_test, y_test,  feature_names_test, label_name_test,  patient_name_test, gaussianKDETest , divided = ft.ReadData(
-        file_name_test, doScale=doScale, doLog=doLog,  doRowNorm = doRowNorm, doMeanto1 = doMeanto1
+        file_name_test, doCache = doCache, doFastRead = doFastRead, preprocessor = preprocessor
     )
+    preprocessor.save(outputPath + "preprocessor.npz")
 
     feature_len = len(feature_names)
     print(f"Number of features: {feature_len}")
@@ -168,66 +207,49 @@ if __name__ == "__main__":
     
     
     
+    data = {
+        "X": X,
+        "Y": Y,
+        "patient_name": patient_name,
+        "X_test": X_test,
+        "y_test": y_test,
+        "feature_names": feature_names,
+        "divided": divided,
+        "gaussianKDE": gaussianKDE,
+        "params": {
+            "BATCH_SIZE": BATCH_SIZE, "TYPE_ACTIVATION": TYPE_ACTIVATION,
+            "DEVICE": DEVICE, "n_hidden": n_hidden, "norm": norm,
+            "GRADIENT_MASK": GRADIENT_MASK, "net_name": net_name, "LR": LR,
+            "criterion_regression": criterion_regression, "outputPath": outputPath,
+            "TYPE_PROJ": TYPE_PROJ, "SEEDS": SEEDS, "nfolds": nfolds,
+            "N_EPOCHS": N_EPOCHS, "N_EPOCHS_MASKGRAD": N_EPOCHS_MASKGRAD,
+            "DO_PROJ_MIDDLE": DO_PROJ_MIDDLE, "ETA": ETA, "ETA_STAR": ETA_STAR,
+            "AXIS": AXIS, "TOL": TOL,
+            "TARGET_FEATURES": TARGET_FEATURES, "VAL_EVERY": VAL_EVERY, "WDNorm": WDNorm,
+            "method": method, "nb_samples": nb_samples, "DoSparsity": DoSparsity,
+            "COMPACT": COMPACT, "PRUNE": PRUNE, "SPARSE_THRESHOLD": SPARSE_THRESHOLD,
+            "LOW_RANK": LOW_RANK,
+        },
+    }
+    # Every (seed, fold) job runs in a worker, results come back in order
+    jobs = [(seed, fold_idx) for seed in SEEDS for fold_idx in range(nfolds)]
+    results = ft.runCrossValJobs(jobs, data, NUM_WORKERS, NUM_THREADS, STACK_MODELS)
+
     for seed in SEEDS:
         
-        
-        np.random.seed(seed)
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
         for fold_idx in range(nfolds):
-            start_time = time.time()
-            train_dl, test_dl, train_len, test_len, Ytest = ft.CrossVal(
-                X, Y, patient_name, BATCH_SIZE, fold_idx, seed
-            )
-            print(
-                "Len of train set: {}, Len of test set: {}".format(train_len, test_len)
-            )
-            print("----------- Start fold ", fold_idx, "----------------")
-            
-            print("----------- Start Training ---------------")
-            # Define the SEED to fix the initial parameters
-            
-            
-            data_encoder, net = ft.training(seed, feature_len, TYPE_ACTIVATION,
-                        DEVICE, n_hidden, norm, feature_names,GRADIENT_MASK,
-                        net_name, LR, criterion_regression, train_dl,
-                        train_len, gaussianKDE, test_dl, test_len, outputPath,
-                        TYPE_PROJ,SEEDS,fold_idx,nfolds, N_EPOCHS,
-                        N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETA, AXIS, TOL)
-            end_time = time.time()
-
-            # Calculate and print the execution time
-            execution_time = end_time - start_time
-            print(f"Execution time for training : {execution_time} seconds for fold {fold_idx}")
-            
-            data_encoder = data_encoder.cpu().detach().numpy()
-
-            (
-                data_encoder_test,
-                Ytrue,
-                Ypred,
-            ) = ft.runBestNet(
-                test_dl,
-                outputPath,
-                fold_idx,
-                net,
-                feature_names,
-                test_len,
-                ETA
-            )
-           
+            res = results[seed_idx * nfolds + fold_idx]
+            net = res["net"]
 
             if seed == SEEDS[-1]:
                 if fold_idx == 0:
-                    Ytruef = Ytrue
-                    Ypredf = Ypred
-                    LP_test = data_encoder_test.detach().cpu().numpy()
+                    Ytruef = res["Ytrue"]
+                    Ypredf = res["Ypred"]
+                    LP_test = res["data_encoder_test"]
                 else:
-                    Ytruef = np.concatenate((Ytruef, Ytrue))
-                    Ypredf = np.concatenate((Ypredf, Ypred))
-                    LP_test = np.concatenate(
-                        (LP_test, data_encoder_test.detach().cpu().numpy())
-                    )
+                    Ytruef = np.concatenate((Ytruef, res["Ytrue"]))
+                    Ypredf = np.concatenate((Ypredf, res["Ypred"]))
+                    LP_test = np.concatenate((LP_test, res["data_encoder_test"]))
                 plt.figure()
                 
                 sns.kdeplot(data=list(np.array(Ypredf) * int(divided)), fill=True,
@@ -241,91 +263,15 @@ if __name__ == "__main__":
                 plt.savefig('plots/distribution'+str(seed)+'.png')
                 plt.show()
                 
-                
-            label_predicted = data_encoder[:, 0]
-            labels_encoder = data_encoder[:, -1]
-            data_encoder_test = data_encoder_test.cpu().detach().numpy()
-            # mse score
-            data_train[seed_idx * 4 + fold_idx, 0] = metrics.mean_squared_error(
-                label_predicted, labels_encoder
-            )
-            
-
-            label_predicted_test = data_encoder_test[:, 0]
-            labels_encodertest = data_encoder_test[:, -1]
-            data_test[seed_idx * 4 + fold_idx, 0] = metrics.mean_squared_error(
-                label_predicted_test, labels_encodertest
-            )
-            
-            data_train[seed_idx * 4 + fold_idx, 1] = metrics.mean_squared_error(
-                label_predicted, labels_encoder
-            )**0.5 * divided
-            
+            # MSE, RMSE, MAE, Negative gap, Positive gap, WD
+            data_train[seed_idx * 4 + fold_idx, :] = res["data_train"]
+            data_test[seed_idx * 4 + fold_idx, :] = res["data_test"]
+            data_finalTest[seed_idx * 4 + fold_idx, :] = res["data_finalTest"]
 
-            data_test[seed_idx * 4 + fold_idx, 1] = metrics.mean_squared_error(
-                label_predicted_test, labels_encodertest
-            )**0.5 * divided
-            
-            #MAE score
-            data_train[seed_idx * 4 + fold_idx, 2] = metrics.mean_absolute_error(
-                label_predicted, labels_encoder
-            )* divided
-            
-            data_test[seed_idx * 4 + fold_idx, 2] = metrics.mean_absolute_error(
-                label_predicted_test, labels_encodertest
-            )* divided
-            
-            data_train[seed_idx * 4 + fold_idx, 3], data_train[seed_idx * 4 + fold_idx, 4] = ft.valueGap(
-                label_predicted, labels_encoder, divided
-            )
-            
-
-            data_test[seed_idx * 4 + fold_idx, 3], data_test[seed_idx * 4 + fold_idx, 4] = ft.valueGap(
-                 label_predicted_test, labels_encodertest, divided
-             )
-             
-            if WDNorm:
-                #WasserteinDistance
-                data_train[seed_idx * 4 + fold_idx, 5] = wasserstein_distance(
-                    labels_encoder/ np.sum(labels_encoder),label_predicted/ np.sum(label_predicted))* divided
-                
-                
-                data_test[seed_idx * 4 + fold_idx, 5] =  wasserstein_distance(
-                    labels_encodertest/ np.sum(labels_encodertest),label_predicted_test/ np.sum(label_predicted_test))* divided
-            else: 
-                data_train[seed_idx * 4 + fold_idx, 5] = wasserstein_distance(
-                    labels_encoder,label_predicted)* divided
-                
-                
-                data_test[seed_idx * 4 + fold_idx, 5] =  wasserstein_distance(
-                    labels_encodertest,label_predicted_test)* divided
-                
-            
+            ft.saveLabelsPred(res["labels"], outputPath, fold_idx, ETA)
             
             # Get Top Genes of each class
-
-            # method = 'Shap'   # (SHapley Additive exPlanation) needs a nb_samples
-            nb_samples = 300  # Randomly choose nb_samples to calculate their Shap Value, time vs nb_samples seems exponential
-            # method = 'Captum_ig'   # Integrated Gradients
-            method = "Captum_dl"  # Deeplift
-            # method = 'Captum_gs'  # GradientShap
-
-            tps1 = time.perf_counter()
-            print("Running topGenes...")
-            df_topGenes = ft.topGenes(
-                X,
-                Y,
-                feature_names,
-                feature_len,
-                method,
-                nb_samples,
-                DEVICE,
-                net,
-                TOL
-            )
-            df_topGenes.index = df_topGenes.iloc[:, 0]
-            print("topGenes finished")
-            tps2 = time.perf_counter()
+            df_topGenes = res["df_topGenes"]
             
             if fold_idx != 0:  #not first fold need to get previous topGenes
                 df = pd.read_csv(
@@ -345,13 +291,9 @@ if __name__ == "__main__":
                 ),
                 sep=";",
             )
-            tps2 = time.perf_counter()
-            print("Execution time topGenes  : ", tps2 - tps1)
                 
             if DoSparsity: 
-                mat_in = net.state_dict()["encoder.0.weight"]
-                mat_col_sparsity = ft.sparsity_col(mat_in, device=DEVICE)
-                sparsity_matrix[seed_idx * 4+ fold_idx, 0] = mat_col_sparsity
+                sparsity_matrix[seed_idx * 4+ fold_idx, 0] = res["sparsity"]
             
             weights, spasity_w = fnp.weights_and_sparsity(net, TOL)
             spasity_percentage_entry = {}
@@ -361,42 +303,14 @@ if __name__ == "__main__":
             layer_list = [x for x in weights.values()]
             ft.show_img(layer_list, file_name)
             
-            print("---------------- Start Testing on the 20% ----------------")
-            
-            #load les dl
-            dtest = ft.LoadDataset(X_test, y_test, list(range(len(X_test))))
-            # _, test_set = torch.utils.data.random_split(dtest, [0])
-            test_dl = torch.utils.data.DataLoader(dtest, batch_size=1)
-            
-            print(
-                "Len of test set: {}".format(len(dtest))
-            )
-            
-            (
-                data_encoder_test20,
-                Ytrue20,
-                Ypred20,
-            ) = ft.runBestNet(
-                test_dl,
-                outputPath,
-                fold_idx,
-                net,
-                feature_names,
-                test_len,
-                ETA
-            )
-            
+            ft.saveLabelsPred(res["labels20"], outputPath, fold_idx, ETA)
             
             if fold_idx == 0:
-                Ytruef20 = Ytrue20
-                Ypredf20 = Ypred20
-                LP_test20 = data_encoder_test20.detach().cpu().numpy()
+                Ytruef20 = res["Ytrue20"]
+                Ypredf20 = res["Ypred20"]
             else:
-                Ytruef20 = np.concatenate((Ytruef20, Ytrue20))
-                Ypredf20 = np.concatenate((Ypredf20, Ypred20))
-                LP_test20 = np.concatenate(
-                    (LP_test20, data_encoder_test20.detach().cpu().numpy())
-                )
+                Ytruef20 = np.concatenate((Ytruef20, res["Ytrue20"]))
+                Ypredf20 = np.concatenate((Ypredf20, res["Ypred20"]))
             plt.figure()
             sns.kdeplot(data=list(np.array(Ypredf20) * int(divided)), fill=True,
                         bw_adjust=0.4, color="tab:blue")
@@ -410,41 +324,7 @@ if __name__ == "__main__":
             plt.show()
             
             ft.figPerAge(np.array(Ytruef20), np.array(Ypredf20),seed, fold_idx)
-                
-            data_encoder_test20 = data_encoder_test20.cpu().detach().numpy()
-            # mse score
-            
-            label_predicted_test20 = data_encoder_test20[:, 0]
-            labels_encodertest20 = data_encoder_test20[:, -1]
-            data_finalTest[seed_idx * 4 + fold_idx, 0] = metrics.mean_squared_error(
-                label_predicted_test20, labels_encodertest20
-            )
-        
-            data_finalTest[seed_idx * 4 + fold_idx, 1] = metrics.mean_squared_error(
-                label_predicted_test20, labels_encodertest20
-            )**0.5 * divided
-            
-            #MAE score
-            data_finalTest[seed_idx * 4 + fold_idx, 2] = metrics.mean_absolute_error(
-                label_predicted_test20, labels_encodertest20
-            )* divided
-            
 
-            data_finalTest[seed_idx * 4 + fold_idx, 3], data_finalTest[seed_idx * 4 + fold_idx, 4]= ft.valueGap(
-                 label_predicted_test20, labels_encodertest20, divided
-             )
-             
-            if WDNorm:
-                #WasserteinDistance
-                data_train[seed_idx * 4 + fold_idx, 5] = wasserstein_distance(
-                    labels_encodertest20/ np.sum(labels_encodertest20),
-                    label_predicted_test20/ np.sum(label_predicted_test20))* divided
-                
-            else: 
-                data_finalTest[seed_idx * 4 + fold_idx, 5] = wasserstein_distance(
-                labels_encodertest20, label_predicted_test20,
-            )* divided
-            
 
 
         # Moyenne sur les SEED
@@ -516,7 +396,7 @@ if __name__ == "__main__":
             )
             
             if DoSparsity: 
-                mat_in = net.state_dict()["encoder.0.weight"]
+                mat_in = ft.inputWeight(net)
                 mat_col_sparsity = ft.sparsity_col(mat_in, device=DEVICE)
                 sparsity_matrix_retraing[seed_idx * 4+ fold_idx, 0] = mat_col_sparsity
         
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright   I3S CNRS UCA
+
+This code runs the cross validation of script_FCNN_regression_CV.py for a
+grid of projection radii ETA. The first descent does not depend on ETA, so
+it is trained once per (seed, fold) and only the projection + masked
+gradient descent is run for every ETA (see ft.trainingSweep).
+
+When using this code , please cite:
+
+Nolwenn Peyratout, Johan Lassen, Sonia Dagnino, Palle Villesen and Michel Barlaud.
+Predicting biological age with metabolomic data using a fully connected neural
+network (FCNN) and feature selection with a sparse bilevel l1inf projection.
+"""
+#%%
+import os
+
+import time
+import pandas as pd
+import numpy as np
+import torch
+from torch import nn
+from sklearn import metrics
+
+import functions.functions_torch_regression_V4 as ft
+
+
+#%%
+
+if __name__ == "__main__":
+
+    ######## Parameters ########
+    start_time = time.time()
+    SEEDS = [5]
+
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    nfolds = 4  # Number of folds for the cross-validation process
+    N_EPOCHS = 30  # Number of epochs for the first descent
+    N_EPOCHS_MASKGRAD = 40  # Number of epochs for training masked gradient
+    LR = 0.0005  # Learning rate
+    BATCH_SIZE = 50
+    VAL_EVERY = 1  # Validate (and keep the best net) every VAL_EVERY epochs
+
+    doScale = False
+    doLog = False
+    doRowNorm = False
+    doMeanto1 = False
+    doCache = True  # cache the preprocessed data (datas/cache/)
+    doFastRead = True  # threaded float32 csv reader (ft.readDataFast)
+
+    criterion_regression = nn.MSELoss(reduction="sum")
+
+    file_name = 'Synth_Reg_500f_64inf_500s.csv'
+
+    net_name = 'FAIR'
+    norm = False
+    n_hidden = 300
+
+    DO_PROJ_MIDDLE = False
+
+    ETAS = [0.1, 0.25, 0.5, 1, 2, 5]  # Projection radii to evaluate
+    ETA_STAR = 100  # Radius of the nuclear norm ball (proj_nuclear)
+    # Number of features to select, if not None ETA of the first layer is
+    # computed to keep exactly this number of features (bilevel l1,inf only)
+    TARGET_FEATURES = None
+
+    TYPE_PROJ = ft.bilevel_proj_l1Inftyball  # projection bilevel l1,inf
+    TYPE_PROJ_NAME = TYPE_PROJ.__name__
+
+    TYPE_ACTIVATION = "silu"
+
+    AXIS = 1  #  1 for columns (features), 0 for rows (neurons)
+    TOL = 1e-3  # error margin for the L1inf algorithm and gradient masking
+    COMPACT = True  # second descent on the selected features only (ft.compactNet)
+
+    SAVE_FILE = True
+
+    ######## Main routine ########
+
+    outputPath = (
+        "results_stat"
+        + "/"
+        + file_name.split(".")[0]
+        + "/"
+    )
+    if not os.path.exists(outputPath):  # make the directory if it does not exist
+        os.makedirs(outputPath)
+
+    preprocessor = ft.Preprocessor(doScale=doScale, doLog=doLog, doRowNorm=doRowNorm,
+                                   doMeanto1=doMeanto1)
+    X, Y, feature_names, label_name_train, patient_name, gaussianKDE, divided = ft.ReadData(
+        file_name, doCache=doCache, doFastRead=doFastRead, preprocessor=preprocessor,
+    )
+    preprocessor.save(outputPath + "preprocessor.npz")  # for inference
+    feature_len = len(feature_names)
+    print(f"Number of features: {feature_len}")
+
+    # MSE, RMSE, MAE, sparsity, number of selected features
+    # for each (ETA, seed x fold)
+    data_test = np.zeros((len(ETAS), nfolds * len(SEEDS), 5))
+
+    # one float32 copy of the data for all the folds
+    folds = ft.CrossValFolds(X, Y, patient_name, device=DEVICE)
+
+    for seed_idx, seed in enumerate(SEEDS):
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        torch.cuda.manual_seed(seed)
+        for fold_idx in range(nfolds):
+            train_dl, test_dl, train_len, test_len, Ytest = folds.fold(
+                seed, fold_idx, BATCH_SIZE
+            )
+            print("----------- Start fold ", fold_idx, "----------------")
+            t1 = time.time()
+            results = ft.trainingSweep(seed, feature_len, TYPE_ACTIVATION,
+                        DEVICE, n_hidden, norm, feature_names, net_name, LR,
+                        criterion_regression, train_dl, train_len, gaussianKDE,
+                        test_dl, test_len, outputPath, TYPE_PROJ, SEEDS, fold_idx,
+                        nfolds, N_EPOCHS, N_EPOCHS_MASKGRAD, DO_PROJ_MIDDLE, ETAS,
+                        AXIS, TOL, VAL_EVERY=VAL_EVERY,
+                        COMPACT=COMPACT, ETA_STAR=ETA_STAR,
+                        TARGET_FEATURES=TARGET_FEATURES)
+            print(f"Execution time for the sweep : {time.time() - t1} seconds for fold {fold_idx}")
+
+            for eta_idx, (ETA, (_, net, best_state)) in enumerate(zip(ETAS, results)):
+                data_encoder_test, Ytrue, Ypred = ft.runBestNet(
+                    test_dl, outputPath, fold_idx, net, feature_names, test_len, ETA,
+                    bestState=best_state,
+                )
+                data_encoder_test = data_encoder_test.cpu().detach().numpy()
+                label_predicted_test = data_encoder_test[:, 0]
+                labels_encodertest = data_encoder_test[:, -1]
+                mse = metrics.mean_squared_error(label_predicted_test, labels_encodertest)
+                col_sparsity = ft.sparsity_col(ft.inputWeight(net), tol=TOL)
+                data_test[eta_idx, seed_idx * nfolds + fold_idx] = [
+                    mse,
+                    mse**0.5 * divided,
+                    metrics.mean_absolute_error(label_predicted_test, labels_encodertest) * divided,
+                    col_sparsity,
+                    round((100 - col_sparsity) / 100 * feature_len),
+                ]
+
+    columns = ["MSE", "RMSE", "MAE", "Sparsity", "Features"]
+    df_sweep = pd.DataFrame(
+        np.concatenate((data_test.mean(axis=1), data_test.std(axis=1)), axis=1),
+        index=pd.Index(ETAS, name="ETA"),
+        columns=["Mean " + c for c in columns] + ["Std " + c for c in columns],
+    )
+    print("\nMetrics Validation per ETA")
+    print(df_sweep)
+
+    if SAVE_FILE:
+        df_sweep.to_csv(
+            "{}{}_ETA_sweep.csv".format(outputPath, str(TYPE_PROJ_NAME)), sep=";"
+        )
+
+    print(f"Execution time: {time.time() - start_time} seconds")
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright   I3S CNRS UCA
+
+Benchmarks of the projections and of the training pipeline.
+
+Choose the benchmarks to run near the start of the script.
+"""
+#%%
+import torch
+
+import functions.functions_benchmark as fb
+
+
+#%%
+
+if __name__ == "__main__":
+
+    ######## Parameters ########
+    DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    REPEAT = 3
+
+    DoBilevelL1inf = True  # bilevel_proj_l1Inftyball, 500 to 200k columns
+    DoL1ball = True  # proj_l1ball, sort vs pivot vs topk crossover
+    DoColumnwise = True  # proj_l11ball, proj_l11ball_line, proj_l21ball engine
+    DoL1inf = True  # proj_l1inf_numpy (loop vs vectorized) vs bilevel
+    DoL1infLine = True  # proj_l1Inftyball_line (loop vs tensorized)
+    DoEtaPath = True  # ETA scan with bilevel_proj_l1Inftyball_path
+    DoLoader = True  # TensorLoader vs LoadDataset + DataLoader
+    DoReader = True  # readDataFast vs readDataFile (pandas)
+    DoMemmap = True  # MemmapLoader vs in-memory data, resident memory
+    DoPrune = True  # pruneNeurons, dead hidden neurons removed
+    DoSparse = True  # sparseNet, CSR products for the sparse layers
+    DoLowRank = True  # lowRankNet, factorized layers after proj_nuclear
+
+    ######## Benchmarks ########
+    if DoBilevelL1inf:
+        fb.bench_bilevel_l1inf(repeat=REPEAT, device=DEVICE)
+    if DoL1ball:
+        fb.bench_l1ball(repeat=REPEAT, device=DEVICE)
+    if DoColumnwise:
+        fb.bench_columnwise(repeat=REPEAT, device=DEVICE)
+    if DoL1inf:
+        fb.bench_l1inf(repeat=REPEAT)
+    if DoL1infLine:
+        fb.bench_l1inf_line(repeat=REPEAT, device=DEVICE)
+    if DoEtaPath:
+        fb.bench_eta_path(repeat=REPEAT, device=DEVICE)
+    if DoLoader:
+        fb.bench_loader(repeat=REPEAT, device=DEVICE)
+    if DoReader:
+        fb.bench_reader(repeat=REPEAT)
+    if DoMemmap:
+        fb.bench_memmap(device=DEVICE)
+    if DoPrune:
+        fb.bench_prune(repeat=REPEAT, device=DEVICE)
+    if DoSparse:
+        fb.bench_sparse(repeat=REPEAT, device=DEVICE, verbose=True)
+    if DoLowRank:
+        fb.bench_lowrank(repeat=REPEAT, device=DEVICE)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright   I3S CNRS UCA
+
+Converts the feature-major csv files of datas/ to sample-major parquet files
+(one column per feature, see ft.csvToParquet). ft.ReadData reads them like
+the csv files, and with features=[...] / samples=[...] only the selected
+columns and rows are read, e.g. the features kept by the projection.
+
+Requires pyarrow.
+"""
+#%%
+import glob
+import os
+
+import functions.functions_torch_regression_V4 as ft
+
+
+#%%
+
+if __name__ == "__main__":
+
+    ######## Parameters ########
+    FILES = glob.glob("datas/*.csv")  # csv files to convert
+    NUM_THREADS = None  # threads of the csv reader, None for all the cores
+    OVERWRITE = False  # convert again the files already converted
+
+    ######## Conversion ########
+    for file_name in FILES:
+        parquet_name = os.path.splitext(file_name)[0] + ".parquet"
+        if os.path.exists(parquet_name) and not OVERWRITE:
+            print("{} already exists".format(parquet_name))
+            continue
+        ft.csvToParquet(file_name, parquet_name, num_threads=NUM_THREADS)
+        print("{} -> {}".format(file_name, parquet_name))